@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for Smart Telegram Bot hot paths
+
+Запуск: python benchmark.py [имя_бенчмарка ...]
+Без аргументов прогоняются все бенчмарки. Модель эмбеддингов загружает только
+encoders — остальные используют случайный энкодер той же размерности, что и
+all-MiniLM-L6-v2.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import closing, contextmanager
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from bot import (EMBEDDING_BACKENDS, EMBEDDING_STORAGE_MODES, DatabaseManager, EmbeddingService,
+                 IVFIndex, Message, OnnxSentenceEncoder, ProcessEncoder, UserProfile, VectorBlock,
+                 VectorMemory, create_encoder, top_k_above)
+
+EMBEDDING_DIM = 384
+
+
+class RandomEncoder:
+    """Подставной энкодер: случайные векторы без загрузки модели"""
+    def __init__(self, dim: int = EMBEDDING_DIM, seed: int = 42):
+        self.dim = dim
+        self.rng = np.random.default_rng(seed)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        return self.rng.standard_normal((len(texts), self.dim)).astype(np.float32)
+
+
+class BusyEncoder(RandomEncoder):
+    """Энкодер, который держит GIL ~1 мс на текст — как токенизация и Python-часть инференса"""
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        deadline = time.perf_counter() + 0.001 * len(texts)
+        while time.perf_counter() < deadline:
+            pass
+        return super().encode(texts)
+
+
+class PerCallDatabaseManager(DatabaseManager):
+    """Прежнее поведение: новое соединение с настройками SQLite по умолчанию на каждый вызов"""
+    def __init__(self, db_path: str, embedding_storage: str = "float32"):
+        self.db_path = db_path
+        self.embedding_storage = embedding_storage
+        self.embedding_model = ""
+        self.init_database()
+
+    @contextmanager
+    def writer(self):
+        with closing(sqlite3.connect(self.db_path)) as conn, conn:
+            yield conn
+
+    reader = writer
+
+    def close(self):
+        pass
+
+
+def make_message(i: int) -> Message:
+    return Message(
+        user_id=i % 50,
+        username=f"user{i % 50}",
+        text=f"сообщение {i}",
+        timestamp=time.time(),
+        chat_id=-100,
+        message_id=i
+    )
+
+
+def measure(func: Callable[[], object], repeat: int = 200) -> float:
+    """Медианное время вызова в миллисекундах"""
+    func()  # прогрев
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+
+def fill_memory(memory: VectorMemory, count: int, rng: np.random.Generator):
+    vectors = rng.standard_normal((count, memory.dim)).astype(np.float32)
+    for i in range(count):
+        memory.add_embedding(make_message(i), vectors[i])
+
+
+def bench_vector_search():
+    """Латентность search_by_vector при ёмкости кольца 1k / 10k / 100k"""
+    rng = np.random.default_rng(0)
+    query = rng.standard_normal(EMBEDDING_DIM).astype(np.float32)
+
+    print("🔍 Поиск по векторной памяти (медиана, мс)")
+    print(f"{'ёмкость':>10} {'1k записей':>12} {'заполнена':>12} {'старый список':>14}")
+    for capacity in (1_000, 10_000, 100_000):
+        memory = VectorMemory("", capacity=capacity, encoder=RandomEncoder())
+        fill_memory(memory, 1_000, rng)
+        partial = measure(lambda: memory.search_by_vector(query, 5))
+
+        fill_memory(memory, capacity, rng)
+        full = measure(lambda: memory.search_by_vector(query, 5), repeat=50)
+
+        # Старая схема: список массивов, который np.dot каждый раз превращает в матрицу
+        legacy = [memory.block.data[i].copy() for i in range(capacity)]
+        legacy_time = measure(lambda: np.argsort(np.dot(legacy, query))[-5:], repeat=20)
+
+        print(f"{capacity:>10} {partial:>12.3f} {full:>12.3f} {legacy_time:>14.3f}")
+
+
+def bench_top_k():
+    """Отбор top-5 выше порога: полная сортировка против argpartition"""
+    rng = np.random.default_rng(0)
+    print("🏁 Отбор top-5 (медиана, мс)")
+    print(f"{'n':>10} {'argsort':>10} {'argpartition':>13}")
+    for count in (1_000, 100_000, 1_000_000):
+        scores = rng.uniform(-1, 1, count).astype(np.float32)
+        full_sort = measure(lambda: [i for i in np.argsort(scores)[-5:][::-1] if scores[i] > 0.3], repeat=20)
+        partition = measure(lambda: top_k_above(scores, 5, 0.3), repeat=20)
+        print(f"{count:>10} {full_sort:>10.3f} {partition:>13.3f}")
+
+
+def clustered_vectors(count: int, rng: np.random.Generator, clusters: int = 2000) -> np.ndarray:
+    """Нормированные векторы вокруг случайных центров — грубая модель реальных эмбеддингов"""
+    centers = rng.standard_normal((clusters, EMBEDDING_DIM)).astype(np.float32)
+    vectors = np.empty((count, EMBEDDING_DIM), dtype=np.float32)
+    for start in range(0, count, 100_000):
+        end = min(start + 100_000, count)
+        noise = rng.standard_normal((end - start, EMBEDDING_DIM)).astype(np.float32)
+        vectors[start:end] = centers[rng.integers(0, clusters, end - start)] + 0.25 * noise
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def bench_ann_recall():
+    """Recall@10 и латентность IVF-индекса против точного поиска
+
+    Размер — BENCH_ANN_SIZE, формат списков — BENCH_ANN_STORAGE, знаковый
+    префильтр — BENCH_ANN_SIGNS=true.
+    """
+    count = int(os.getenv("BENCH_ANN_SIZE", "200000"))
+    storage = os.getenv("BENCH_ANN_STORAGE", "float32")
+    with_signs = os.getenv("BENCH_ANN_SIGNS", "false").lower() == "true"
+    k = 10
+    rng = np.random.default_rng(1)
+    vectors = clustered_vectors(count, rng)
+    queries = vectors[rng.integers(0, count, 100)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+
+    index = IVFIndex(EMBEDDING_DIM, storage=storage, binary_prefilter=with_signs)
+    start = time.perf_counter()
+    for offset in range(0, count, 10_000):
+        index.add(np.arange(offset, min(offset + 10_000, count)), vectors[offset:offset + 10_000])
+        index.wait_for_retrain()
+    build_time = time.perf_counter() - start
+
+    exact = [set(np.argpartition(-(vectors @ q), k)[:k].tolist()) for q in queries]
+    exact_time = measure(lambda: np.argpartition(-(vectors @ queries[0]), k)[:k], repeat=20)
+
+    print(f"🗂️ IVF-Flat ({storage}{' + sign' if with_signs else ''}): {count} векторов, "
+          f"{len(index.state.sizes)} кластеров, "
+          f"построение {build_time:.1f}с, точный поиск {exact_time:.3f} мс")
+    print(f"{'nprobe':>8} {'recall@10':>10} {'мс/запрос':>10}")
+    for nprobe in (1, 2, 4, 8, 16, 32, 64):
+        index.nprobe = nprobe
+        found = [set(index.search(q, k)[0].tolist()) for q in queries]
+        recall = np.mean([len(f & e) / k for f, e in zip(found, exact)])
+        latency = measure(lambda: [index.search(q, k) for q in queries[:10]], repeat=20) / 10
+        print(f"{nprobe:>8} {recall:>10.3f} {latency:>10.3f}")
+
+
+def bench_quantization():
+    """Память на вектор, recall@10 и латентность для форматов хранения (размер: BENCH_QUANT_SIZE)"""
+    count = int(os.getenv("BENCH_QUANT_SIZE", "100000"))
+    k = 10
+    rng = np.random.default_rng(2)
+    vectors = clustered_vectors(count, rng)
+    queries = vectors[rng.integers(0, count, 100)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    exact = [set(np.argpartition(-(vectors @ q), k)[:k].tolist()) for q in queries]
+
+    print(f"🗜️ Форматы хранения: {count} векторов")
+    print(f"{'формат':>18} {'байт/вектор':>12} {'сжатие':>7} {'recall@10':>10} {'мс/запрос':>10}")
+    for mode in EMBEDDING_STORAGE_MODES:
+        for with_signs in (False, True):
+            block = VectorBlock(count, EMBEDDING_DIM, mode, with_signs)
+            block.write(0, vectors)
+            found = [set(block.search(q, count, k, -1.0)[0].tolist()) for q in queries]
+            recall = np.mean([len(f & e) / k for f, e in zip(found, exact)])
+            latency = measure(lambda: block.search(queries[0], count, k, -1.0), repeat=20)
+            name = mode + (" + sign" if with_signs else "")
+            compression = EMBEDDING_DIM * 4 / block.bytes_per_vector
+            print(f"{name:>18} {block.bytes_per_vector:>12} {compression:>6.1f}x "
+                  f"{recall:>10.3f} {latency:>10.3f}")
+
+
+def encoder_stats(backend: str) -> Dict[str, float]:
+    """Загрузка энкодера и замеры в отдельном процессе, чтобы RSS не смешивался"""
+    model = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+    onnx_dir = os.getenv("EMBEDDING_ONNX_DIR", "models/onnx")
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    encoder = create_encoder(model, backend, onnx_dir, max_seq_length=128)
+    if backend != "torch" and not isinstance(encoder, OnnxSentenceEncoder):
+        raise RuntimeError("ONNX-бэкенд недоступен, энкодер откатился на PyTorch")
+    short = "ну чё как там с сервером, опять упал?"
+    long = " ".join([short] * 200)
+    return {
+        "short": measure(lambda: encoder.encode([short]), repeat=50),
+        "long": measure(lambda: encoder.encode([long]), repeat=10),
+        "batch": measure(lambda: encoder.encode([short] * 32, batch_size=32), repeat=10) / 32,
+        "rss_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+    }
+
+
+def bench_encoders():
+    """Латентность encode на сообщение и прирост RSS для бэкендов энкодера (нужна модель)"""
+    print("⚡ Бэкенды энкодера (медиана, мс; RSS — прирост пикового, МБ)")
+    print(f"{'бэкенд':>10} {'короткое':>9} {'длинное':>8} {'в батче 32':>11} {'RSS':>7}")
+    context = multiprocessing.get_context("spawn")
+    for backend in EMBEDDING_BACKENDS:
+        with context.Pool(1) as pool:
+            try:
+                stats = pool.apply(encoder_stats, (backend,))
+            except Exception as e:
+                print(f"{backend:>10} пропущен: {e}")
+                continue
+        print(f"{backend:>10} {stats['short']:>9.2f} {stats['long']:>8.2f} "
+              f"{stats['batch']:>11.2f} {stats['rss_mb']:>7.0f}")
+
+
+def make_profile(i: int, rng: np.random.Generator) -> UserProfile:
+    return UserProfile(
+        user_id=i % 500,
+        username=f"user{i % 500}",
+        personality_traits={"активность": 0.5, "дружелюбность": 0.5},
+        interests=["python", "linux"],
+        interaction_count=i,
+        last_seen=time.time(),
+        relationship_level="знакомый",
+        interest_vector=rng.standard_normal(EMBEDDING_DIM).astype(np.float32),
+        interest_samples=i,
+    )
+
+
+def bench_database():
+    """Пропускная способность записи: по одной и пачками (BENCH_DB_WRITES записей, пачка BENCH_DB_BATCH)"""
+    count = int(os.getenv("BENCH_DB_WRITES", "2000"))
+    rng = np.random.default_rng(3)
+    embeddings = rng.standard_normal((count, EMBEDDING_DIM)).astype(np.float32)
+    messages = [make_message(i) for i in range(count)]
+    profiles = [make_profile(i, rng) for i in range(count)]
+
+    batch = int(os.getenv("BENCH_DB_BATCH", "256"))
+
+    print(f"💾 Запись в SQLite: {count} операций каждого вида (операций в секунду)")
+    print(f"{'соединения':>24} {'save_message':>13} {'save_user_profile':>18}")
+    for name, manager_class, batched in (("новое на вызов", PerCallDatabaseManager, False),
+                                         ("постоянные, WAL", DatabaseManager, False),
+                                         (f"WAL, пачки по {batch}", DatabaseManager, True)):
+        with tempfile.TemporaryDirectory() as directory:
+            db = manager_class(os.path.join(directory, "bench.db"))
+            start = time.perf_counter()
+            if batched:
+                for i in range(0, count, batch):
+                    db.write_batch([db.message_row(message, embedding) for message, embedding
+                                    in zip(messages[i:i + batch], embeddings[i:i + batch])])
+            else:
+                for message, embedding in zip(messages, embeddings):
+                    db.save_message(message, embedding)
+            message_rate = count / (time.perf_counter() - start)
+            start = time.perf_counter()
+            if batched:
+                for i in range(0, count, batch):
+                    db.write_batch([], [db.profile_row(profile) for profile in profiles[i:i + batch]])
+            else:
+                for profile in profiles:
+                    db.save_user_profile(profile)
+            profile_rate = count / (time.perf_counter() - start)
+            db.close()
+        print(f"{name:>24} {message_rate:>13.0f} {profile_rate:>18.0f}")
+
+
+async def loop_lag_during_burst(encoder, count: int = 500) -> Tuple[float, float]:
+    """Задержка тиков event loop'а (p95 и максимум, мс), пока кодируется пачка сообщений"""
+    service = EmbeddingService(encoder)
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            expected = loop.time() + 0.001
+            await asyncio.sleep(0.001)
+            lags.append((loop.time() - expected) * 1000)
+
+    ticks = asyncio.ensure_future(ticker())
+    await asyncio.gather(*[service.embed(f"сообщение {i}") for i in range(count)])
+    done.set()
+    await ticks
+    await service.close()
+    if not lags:
+        return 0.0, 0.0
+    return float(np.percentile(lags, 95)), max(lags)
+
+
+def bench_loop_lag():
+    """Задержка event loop'а при всплеске сообщений: энкодер в потоке против процесса"""
+    print("⏱️ Лаг event loop'а при всплеске из 500 сообщений (мс)")
+    print(f"{'энкодер':>10} {'p95':>8} {'макс.':>8}")
+    thread_lag = asyncio.run(loop_lag_during_burst(BusyEncoder()))
+    encoder = ProcessEncoder(BusyEncoder)
+    try:
+        process_lag = asyncio.run(loop_lag_during_burst(encoder))
+    finally:
+        encoder.close()
+    for name, (p95, worst) in (("поток", thread_lag), ("процесс", process_lag)):
+        print(f"{name:>10} {p95:>8.1f} {worst:>8.1f}")
+
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {
+    "vector_search": bench_vector_search,
+    "top_k": bench_top_k,
+    "ann_recall": bench_ann_recall,
+    "quantization": bench_quantization,
+    "encoders": bench_encoders,
+    "loop_lag": bench_loop_lag,
+    "database": bench_database,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"❌ Неизвестный бенчмарк: {name}. Доступны: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,19 +12,24 @@ Repository: https://github.com/R0D10Nq/BydlanBot
 """
 
 import os
+import functools
+import itertools
+import multiprocessing
 import aiohttp
 import asyncio
 import logging
 import time
 import json
+import re
 import sqlite3
 import pickle
 import hashlib
+import gzip
 
 from datetime import datetime, timedelta
-from collections import defaultdict, deque
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple, Any
+from collections import Counter, OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple, Any
 from dotenv import load_dotenv
 
 # Настройка логов (ВАЖНО: до импортов с try/except)
@@ -66,12 +71,16 @@ class Constants:
     
     # Дефолтные значения
     DEFAULT_CLEANUP_DAYS = 30
+    
+    # Память
+    MEMORY_SIMILARITY_THRESHOLD = 0.3  # минимальная близость для "воспоминания"
 
 from telegram import Update, User
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import threading
+from contextlib import contextmanager
 
 # Для работы с часовыми поясами
 try:
@@ -81,6 +90,13 @@ except ImportError:
     HAS_PYTZ = False
     logger.warning("⚠️ pytz не установлен. Установи: pip install pytz")
 
+# Опциональный ONNX-бэкенд энкодера
+try:
+    import onnxruntime
+    HAS_ONNXRUNTIME = True
+except ImportError:
+    HAS_ONNXRUNTIME = False
+
 
 # === КОНФИГУРАЦИЯ БОТА ===
 @dataclass
@@ -96,8 +112,63 @@ class BotConfig:
     context_window: int = 250
     response_probability: float = 0.3
     cleanup_interval: int = 7200
+    retention_batch_size: int = 5000  # строк (по диапазону rowid) на одну транзакцию удаления
+    retention_pause_ms: float = 50.0  # пауза между пачками удаления
+    retention_archive_dir: str = ""  # куда складывать удаляемые сообщения (gzip-JSONL); пусто — не архивировать
     memory_db_path: str = "bot_memory.db"
+    db_cache_size_mb: int = 64  # страничный кэш SQLite на соединение
+    db_mmap_size_mb: int = 256  # сколько файла базы читать через mmap
     embedding_model: str = "all-MiniLM-L6-v2"
+    embedding_backend: str = "torch"  # torch / onnx / onnx-int8
+    embedding_onnx_dir: str = "models/onnx"  # куда экспортируется ONNX-модель
+    embedding_max_seq_length: int = 128  # длинные посты обрезаются до стольких токенов
+    vector_memory_capacity: int = 1000  # размер кольца эмбеддингов в RAM
+    embedding_batch_wait_ms: float = 5.0  # окно сбора микро-батча для encode
+    embedding_max_batch: int = 32
+    embedding_cache_size: int = 4096  # LRU-кэш эмбеддингов по хэшу текста
+    embedding_max_pending: int = 256  # больше запросов в очереди — embed() ждёт (backpressure)
+    embedding_worker_process: bool = False  # модель в отдельном процессе, а не в потоке
+    # Фильтр входящих: дубли и всплески коротких сообщений
+    ingest_duplicate_window: float = 120.0  # секунд помнить хэши текстов
+    ingest_collapse_window: float = 10.0  # одно короткое сообщение на чат за окно
+    ingest_short_length: int = 4  # «+», «лол», «ок» и т.п.
+    # Запись в БД: одна очередь, один писатель, пачка — одна транзакция
+    write_batch_size: int = 256
+    write_flush_ms: float = 200.0  # сколько ждать добора пачки
+    write_queue_size: int = 4096  # больше — enrich_message ждёт (backpressure)
+    profile_flush_interval: int = 30  # секунд между сбросами изменённых профилей
+    profile_cache_size: int = 10000  # профилей в памяти (LRU поверх user_profiles)
+    profile_preload_days: int = 7  # при старте загрузить активных за столько дней; 0 — не грузить
+    # Фоновое обогащение сообщений, на которые бот не отвечает
+    enrichment_batch_size: int = 64
+    enrichment_max_wait_ms: float = 1000.0
+    # Долговременная память: IVF-индекс по всем эмбеддингам из БД
+    enable_long_term_memory: bool = True
+    ivf_nprobe: int = 4
+    ivf_nlist: int = 0  # 0 — автоматически, ≈ sqrt(числа векторов)
+    vector_log_dir: str = ""  # журнал эмбеддингов на memmap-сегментах; пусто — выключен
+    vector_log_period_days: int = 7  # период одного сегмента журнала
+    intent_centroids_path: str = "intent_centroids.npz"  # центроиды роутера намерений (tools.py fit-intents)
+    # Ниже порогов центроид считается неуверенным, и намерение берётся по ключевым словам
+    intent_min_score: float = 0.3  # близость к ближайшему центроиду
+    intent_min_margin: float = 0.05  # отрыв от второго по близости
+    # Формат хранения эмбеддингов в RAM и БД: float32 / float16 / int8
+    # (float16 без binary_prefilter ищет в разы медленнее float32 — см. VectorBlock)
+    embedding_storage: str = "float32"
+    binary_prefilter: bool = False  # отбор кандидатов по знаковым битам + точный пересчёт
+    prefilter_rerank_factor: int = 20  # кандидатов на пересчёт = limit * factor
+    # Ранжирование воспоминаний: близость + важность + свежесть
+    retrieval_similarity_weight: float = 1.0
+    retrieval_importance_weight: float = 0.3
+    retrieval_recency_weight: float = 0.3
+    retrieval_half_life_hours: float = 72.0  # за это время вклад свежести падает вдвое
+    # Гибридный поиск воспоминаний: FTS5 (BM25) + векторы, слияние по RRF
+    keyword_search: bool = True
+    rrf_k: int = 60  # сглаживание RRF: больше — ровнее вклад нижних мест
+    # Кластеры интересов пользователей (фоновый mini-batch k-means)
+    interest_clusters: int = 4
+    interest_min_messages: int = 20  # меньше сообщений — кластеры не строим
+    interest_refresh_interval: int = 3600
     max_parallel_requests: int = 4
     # Новые настройки для расписания
     enable_schedule: bool = True
@@ -132,6 +203,18 @@ def create_bot_config() -> BotConfig:
             logger.warning(f"⚠️ FLOOD_TOPIC_ID должен быть числом, получен: {flood_topic_id}. Используется None")
             flood_topic_id = None
     
+    embedding_storage = os.getenv('EMBEDDING_STORAGE', 'float32').lower()
+    if embedding_storage not in EMBEDDING_STORAGE_MODES:
+        logger.warning(f"⚠️ EMBEDDING_STORAGE должен быть одним из {EMBEDDING_STORAGE_MODES}, "
+                       f"получен: {embedding_storage}. Используется float32")
+        embedding_storage = 'float32'
+    
+    embedding_backend = os.getenv('EMBEDDING_BACKEND', 'torch').lower()
+    if embedding_backend not in EMBEDDING_BACKENDS:
+        logger.warning(f"⚠️ EMBEDDING_BACKEND должен быть одним из {EMBEDDING_BACKENDS}, "
+                       f"получен: {embedding_backend}. Используется torch")
+        embedding_backend = 'torch'
+    
     return BotConfig(
         telegram_bot_token=bot_token,
         chat_id=chat_id,
@@ -143,8 +226,53 @@ def create_bot_config() -> BotConfig:
         context_window=int(os.getenv('CONTEXT_WINDOW', '250')),
         response_probability=float(os.getenv('RESPONSE_PROBABILITY', '0.3')),
         cleanup_interval=int(os.getenv('CLEANUP_INTERVAL', '7200')),
+        retention_batch_size=int(os.getenv('RETENTION_BATCH_SIZE', '5000')),
+        retention_pause_ms=float(os.getenv('RETENTION_PAUSE_MS', '50')),
+        retention_archive_dir=os.getenv('RETENTION_ARCHIVE_DIR', ''),
         memory_db_path=os.getenv('MEMORY_DB_PATH', 'bot_memory.db'),
+        db_cache_size_mb=int(os.getenv('DB_CACHE_SIZE_MB', '64')),
+        db_mmap_size_mb=int(os.getenv('DB_MMAP_SIZE_MB', '256')),
         embedding_model=os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2'),
+        embedding_backend=embedding_backend,
+        embedding_onnx_dir=os.getenv('EMBEDDING_ONNX_DIR', 'models/onnx'),
+        embedding_max_seq_length=int(os.getenv('EMBEDDING_MAX_SEQ_LENGTH', '128')),
+        vector_memory_capacity=int(os.getenv('VECTOR_MEMORY_CAPACITY', '1000')),
+        embedding_batch_wait_ms=float(os.getenv('EMBEDDING_BATCH_WAIT_MS', '5')),
+        embedding_max_batch=int(os.getenv('EMBEDDING_MAX_BATCH', '32')),
+        embedding_cache_size=int(os.getenv('EMBEDDING_CACHE_SIZE', '4096')),
+        embedding_max_pending=int(os.getenv('EMBEDDING_MAX_PENDING', '256')),
+        embedding_worker_process=os.getenv('EMBEDDING_WORKER_PROCESS', 'false').lower() == 'true',
+        ingest_duplicate_window=float(os.getenv('INGEST_DUPLICATE_WINDOW', '120')),
+        ingest_collapse_window=float(os.getenv('INGEST_COLLAPSE_WINDOW', '10')),
+        ingest_short_length=int(os.getenv('INGEST_SHORT_LENGTH', '4')),
+        write_batch_size=int(os.getenv('WRITE_BATCH_SIZE', '256')),
+        write_flush_ms=float(os.getenv('WRITE_FLUSH_MS', '200')),
+        write_queue_size=int(os.getenv('WRITE_QUEUE_SIZE', '4096')),
+        profile_flush_interval=int(os.getenv('PROFILE_FLUSH_INTERVAL', '30')),
+        profile_cache_size=int(os.getenv('PROFILE_CACHE_SIZE', '10000')),
+        profile_preload_days=int(os.getenv('PROFILE_PRELOAD_DAYS', '7')),
+        enrichment_batch_size=int(os.getenv('ENRICHMENT_BATCH_SIZE', '64')),
+        enrichment_max_wait_ms=float(os.getenv('ENRICHMENT_MAX_WAIT_MS', '1000')),
+        enable_long_term_memory=os.getenv('LONG_TERM_MEMORY', 'true').lower() == 'true',
+        ivf_nprobe=int(os.getenv('IVF_NPROBE', '4')),
+        ivf_nlist=int(os.getenv('IVF_NLIST', '0')),
+        vector_log_dir=os.getenv('VECTOR_LOG_DIR', ''),
+        vector_log_period_days=int(os.getenv('VECTOR_LOG_PERIOD_DAYS', '7')),
+        intent_centroids_path=os.getenv('INTENT_CENTROIDS_PATH', 'intent_centroids.npz'),
+        intent_min_score=float(os.getenv('INTENT_MIN_SCORE', '0.3')),
+        intent_min_margin=float(os.getenv('INTENT_MIN_MARGIN', '0.05')),
+        embedding_storage=embedding_storage,
+        binary_prefilter=os.getenv('BINARY_PREFILTER', 'false').lower() == 'true',
+        prefilter_rerank_factor=int(os.getenv('PREFILTER_RERANK_FACTOR', '20')),
+        retrieval_similarity_weight=float(os.getenv('RETRIEVAL_SIMILARITY_WEIGHT', '1.0')),
+        retrieval_importance_weight=float(os.getenv('RETRIEVAL_IMPORTANCE_WEIGHT', '0.3')),
+        retrieval_recency_weight=float(os.getenv('RETRIEVAL_RECENCY_WEIGHT', '0.3')),
+        retrieval_half_life_hours=float(os.getenv('RETRIEVAL_HALF_LIFE_HOURS', '72')),
+        keyword_search=os.getenv('KEYWORD_SEARCH', 'true').lower() == 'true',
+        rrf_k=int(os.getenv('RRF_K', '60')),
+        interest_clusters=int(os.getenv('INTEREST_CLUSTERS', '4')),
+        interest_min_messages=int(os.getenv('INTEREST_MIN_MESSAGES', '20')),
+        interest_refresh_interval=int(os.getenv('INTEREST_REFRESH_INTERVAL', '3600')),
         max_parallel_requests=int(os.getenv('MAX_PARALLEL', '4')),
         enable_schedule=os.getenv('ENABLE_SCHEDULE', 'true').lower() == 'true',
         morning_time=os.getenv('MORNING_TIME', '08:00'),
@@ -314,6 +442,8 @@ class Message:
     importance: float = 0.5
     has_image: bool = False
     image_description: Optional[str] = None
+    embedding: Optional[np.ndarray] = None  # считается один раз и переиспользуется везде
+    thread_id: Optional[int] = None  # топик супергруппы
 
 @dataclass
 class UserProfile:
@@ -324,62 +454,1406 @@ class UserProfile:
     interaction_count: int
     last_seen: float
     relationship_level: str
+    interest_vector: Optional[np.ndarray] = None  # среднее нормированных эмбеддингов сообщений
+    interest_samples: int = 0
+    # Кластеры интересов по чатам (фоновый k-means): подписи из лички не попадают в группу
+    interest_centroids: Dict[int, np.ndarray] = field(default_factory=dict)
+    interest_labels: Dict[int, List[str]] = field(default_factory=dict)  # ключевые слова кластеров
+    
+    def observe_embedding(self, embedding: np.ndarray):
+        """Обновить скользящее среднее интересов за O(d)"""
+        embedding = l2_normalize(embedding)
+        self.interest_samples += 1
+        if self.interest_vector is None:
+            self.interest_vector = embedding.copy()
+        else:
+            self.interest_vector += (embedding - self.interest_vector) / self.interest_samples
+
+
+
+def l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    """Нормировать векторы (или один вектор) на единичную длину: dot = косинусная близость"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def top_k_above(scores: np.ndarray, k: int, threshold: float) -> np.ndarray:
+    """Индексы не более k лучших значений выше порога, по убыванию
+    
+    Порог применяется маской до отбора, отбор — argpartition за O(n),
+    сортируются только k победителей. Если прошедших порог меньше k,
+    возвращаются все они в детерминированном порядке.
+    """
+    candidates = np.flatnonzero(scores > threshold)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+def reciprocal_rank_fusion(rankings: List[List[Message]], limit: int, k: int = 60) -> List[Message]:
+    """Слить несколько ранжированных списков сообщений по RRF
+    
+    score = Σ 1 / (k + место в списке). Шкалы исходных оценок (косинус, BM25)
+    не сравниваются — важны только места, так что нормировать их не нужно.
+    Сообщение узнаётся по (chat_id, message_id).
+    """
+    scores: Dict[Tuple[int, int], float] = defaultdict(float)
+    messages: Dict[Tuple[int, int], Message] = {}
+    for ranking in rankings:
+        for rank, message in enumerate(ranking, start=1):
+            key = (message.chat_id, message.message_id)
+            scores[key] += 1.0 / (k + rank)
+            messages.setdefault(key, message)
+    best = sorted(scores, key=lambda key: scores[key], reverse=True)[:limit]
+    return [messages[key] for key in best]
+
+# Служебные слова: не годятся ни в подписи интересов, ни в поисковые термины
+STOPWORDS = frozenset("""
+    и в во не что он на я с со как а то все всё она так его но да ты к у же вы за бы по только её ее мне
+    было вот от меня ещё еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до
+    вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их
+    чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой
+    совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при
+    наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве три
+    эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю
+    между это просто вообще очень тебе короче типа блин щас чё че лол кек ага неа норм вроде
+""".split())
+
+def interest_keywords(cluster_texts: List[str], chat_texts: List[str], limit: int = 3,
+                      min_messages: int = 2) -> str:
+    """Подпись кластера интересов: характерные для него слова, а не текст сообщения
+    
+    Слово попадает в подпись, только если встречается минимум в `min_messages`
+    сообщениях кластера, — разовые имена, номера и прочие частности не всплывают.
+    Характерность — доля сообщений кластера со словом среди всех сообщений чата с ним.
+    """
+    def message_counts(texts: List[str]) -> Counter:
+        counts = Counter()
+        for text in texts:
+            counts.update({word for word in re.findall(r'[^\W\d_]{4,}', text.lower())
+                           if word not in STOPWORDS})
+        return counts
+    
+    inside, overall = message_counts(cluster_texts), message_counts(chat_texts)
+    words = [word for word, count in inside.items() if count >= min_messages]
+    words.sort(key=lambda word: (inside[word] ** 2 / overall[word], word), reverse=True)
+    return ", ".join(words[:limit])
+
+def minibatch_kmeans(vectors: np.ndarray, k: int, batch_size: int = 256, iterations: int = 50,
+                     seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Сферический mini-batch k-means (Sculley, 2010): (центроиды, метки всех векторов)
+    
+    Каждая итерация двигает центроиды к случайной подвыборке с шагом 1/число_попаданий,
+    так что время не зависит от объёма истории пользователя.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = l2_normalize(np.asarray(vectors, dtype=np.float32))
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    counts = np.zeros(k, dtype=np.int64)
+    
+    for _ in range(iterations):
+        batch = vectors[rng.choice(len(vectors), min(batch_size, len(vectors)), replace=False)]
+        assignment = np.argmax(batch @ centroids.T, axis=1)
+        for cluster in np.unique(assignment):
+            members = batch[assignment == cluster]
+            counts[cluster] += len(members)
+            rate = len(members) / counts[cluster]
+            centroids[cluster] += rate * (members.mean(axis=0) - centroids[cluster])
+        centroids = l2_normalize(centroids)
+    
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+class Histogram:
+    """Простая гистограмма с фиксированными границами корзин (для /status)"""
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+    
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum += value
+    
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+    
+    def render(self) -> str:
+        """Компактное представление: ≤граница:количество, пустые корзины пропускаются"""
+        labels = [f"≤{b:g}" for b in self.bounds] + [f">{self.bounds[-1]:g}"]
+        parts = [f"{label}:{count}" for label, count in zip(labels, self.counts) if count]
+        return " ".join(parts) if parts else "нет данных"
+
+
+EMBEDDING_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+class OnnxSentenceEncoder:
+    """Энкодер sentence-transformers через onnxruntime на CPU
+    
+    Интерфейс как у SentenceTransformer (encode / get_sentence_embedding_dimension),
+    так что EmbeddingService и VectorMemory работают с ним без изменений.
+    Пулинг — среднее по токенам с маской внимания и L2-нормировка, как у
+    all-MiniLM-L6-v2. Текст обрезается до `max_seq_length` токенов.
+    
+    Если в `model_dir` нет экспортированной модели, она экспортируется из
+    `model_name` при первом запуске (нужны torch и onnxruntime), int8-вариант
+    получается динамическим квантованием весов.
+    """
+    MODEL_FILES = {'onnx': 'model.onnx', 'onnx-int8': 'model_int8.onnx'}
+    
+    def __init__(self, model_name: str, model_dir: str, backend: str = 'onnx',
+                 max_seq_length: int = 128):
+        from transformers import AutoTokenizer
+        
+        model_path = os.path.join(model_dir, self.MODEL_FILES[backend])
+        if not os.path.exists(model_path):
+            self.export(model_name, model_dir)
+        
+        self.max_seq_length = max_seq_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.dim = self.session.get_outputs()[0].shape[-1]
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+    
+    def encode(self, texts: List[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        embeddings = []
+        for start in range(0, len(texts), batch_size):
+            tokens = self.tokenizer(
+                texts[start:start + batch_size], padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors='np'
+            )
+            inputs = {name: value.astype(np.int64) for name, value in tokens.items()
+                      if name in self.input_names}
+            hidden = self.session.run(None, inputs)[0]
+            mask = tokens['attention_mask'][..., None].astype(np.float32)
+            embeddings.append((hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9))
+        if not embeddings:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return l2_normalize(np.concatenate(embeddings))
+    
+    @classmethod
+    def export(cls, model_name: str, model_dir: str):
+        """Экспортировать трансформер модели в ONNX (float32 и int8)"""
+        import torch
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        
+        logger.info(f"📦 Экспортирую {model_name} в ONNX: {model_dir}")
+        os.makedirs(model_dir, exist_ok=True)
+        model = SentenceTransformer(model_name, device='cpu')
+        transformer = model[0].auto_model.eval()
+        model.tokenizer.save_pretrained(model_dir)
+        
+        sample = model.tokenizer(["пример текста"], return_tensors='pt')
+        input_names = list(sample.keys())
+        dynamic_axes = {name: {0: 'batch', 1: 'tokens'} for name in input_names}
+        dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'tokens'}
+        model_path = os.path.join(model_dir, cls.MODEL_FILES['onnx'])
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer, tuple(sample[name] for name in input_names), model_path,
+                input_names=input_names, output_names=['last_hidden_state'],
+                dynamic_axes=dynamic_axes, opset_version=14
+            )
+        quantize_dynamic(model_path, os.path.join(model_dir, cls.MODEL_FILES['onnx-int8']),
+                         weight_type=QuantType.QInt8)
+
+def create_encoder(model_name: str, backend: str = 'torch', onnx_dir: str = 'models/onnx',
+                   max_seq_length: int = 128) -> Any:
+    """Энкодер выбранного бэкенда; при недоступности ONNX — откат на PyTorch"""
+    if backend != 'torch':
+        if HAS_ONNXRUNTIME:
+            try:
+                encoder = OnnxSentenceEncoder(model_name, onnx_dir, backend, max_seq_length)
+                logger.info(f"⚡ Энкодер: {backend} ({onnx_dir})")
+                return encoder
+            except Exception as e:
+                logger.error(f"❌ Не удалось поднять ONNX-энкодер: {e}. Использую PyTorch")
+        else:
+            logger.warning("⚠️ onnxruntime не установлен. Установи: pip install onnxruntime")
+    
+    encoder = SentenceTransformer(model_name)
+    encoder.max_seq_length = max_seq_length
+    return encoder
+
+def _embedding_worker_main(conn: Any, factory: Callable[[], Any]):
+    """Точка входа процесса эмбеддингов: списки текстов по пайпу, float32-байты обратно"""
+    encoder = factory()
+    conn.send(('ready', encoder.get_sentence_embedding_dimension()))
+    while True:
+        try:
+            texts = conn.recv()
+        except EOFError:
+            break
+        if texts is None:
+            break
+        try:
+            vectors = np.ascontiguousarray(encoder.encode(texts, batch_size=len(texts)), dtype=np.float32)
+        except Exception as e:
+            conn.send(('error', str(e)))
+            continue
+        conn.send(('ok', len(texts)))
+        conn.send_bytes(vectors.tobytes())
+
+class ProcessEncoder:
+    """Энкодер в отдельном процессе: инференс не делит GIL с event loop'ом
+    
+    Интерфейс как у SentenceTransformer. Вызов encode блокирует вызывающий поток
+    (EmbeddingService зовёт его из пула потоков), а модель работает в дочернем
+    процессе, запущенном через spawn. Если процесс упал или не ответил за
+    `request_timeout` секунд, он перезапускается и запрос повторяется один раз.
+    """
+    def __init__(self, factory: Callable[[], Any], start_timeout: float = 300.0,
+                 request_timeout: float = 60.0):
+        self.factory = factory
+        self.start_timeout = start_timeout
+        self.request_timeout = request_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.dim = 0
+        self.restarts = 0
+        self.lock = threading.Lock()
+        self._start()
+    
+    def _start(self):
+        parent_conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_embedding_worker_main, args=(child_conn, self.factory),
+            name="embedding-worker", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        
+        if not parent_conn.poll(self.start_timeout):
+            self._stop()
+            raise RuntimeError("Процесс эмбеддингов не запустился")
+        _, self.dim = parent_conn.recv()
+        logger.info(f"🧮 Процесс эмбеддингов запущен (pid {self.process.pid})")
+    
+    def _stop(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+            self.process = None
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+    
+    def _request(self, texts: List[str]) -> np.ndarray:
+        if self.process is None or not self.process.is_alive():
+            self._stop()
+            self.restarts += 1
+            self._start()
+        
+        self.conn.send(texts)
+        if not self.conn.poll(self.request_timeout):
+            raise TimeoutError(f"нет ответа за {self.request_timeout:.0f}с")
+        status, payload = self.conn.recv()
+        if status == 'error':
+            raise ValueError(payload)
+        return np.frombuffer(self.conn.recv_bytes(), dtype=np.float32).reshape(payload, self.dim)
+    
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        texts = list(texts)
+        with self.lock:
+            try:
+                return self._request(texts)
+            except (EOFError, OSError, TimeoutError) as e:
+                logger.error(f"💥 Процесс эмбеддингов упал ({e}), перезапускаю")
+                if self.process is not None:
+                    self.process.kill()
+                    self.process.join()
+                return self._request(texts)
+    
+    def close(self):
+        """Попросить процесс завершиться и дождаться его"""
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self.conn.send(None)
+                except OSError:
+                    pass
+            self._stop()
+
+async def collect_batch(queue: asyncio.Queue, max_size: int, max_wait: float) -> list:
+    """Дождаться первого элемента очереди и добрать ещё до max_size за max_wait секунд"""
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + max_wait
+    while len(batch) < max_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+class EmbeddingService:
+    """Асинхронный сервис эмбеддингов с микро-батчингом и LRU-кэшем
+    
+    Запросы копятся в очереди до `max_wait_ms` миллисекунд (или до `max_batch` штук),
+    затем одним вызовом `encode` кодируются в пуле потоков, и каждый вызывающий
+    получает свой вектор через future.
+    
+    Перед очередью стоит ограниченный LRU-кэш по хэшу нормализованного текста:
+    повторяющиеся копипасты и приветствия модель не трогают. Одинаковые тексты,
+    которые уже кодируются, ждут общий future вместо повторного encode.
+    Возвращаемые векторы только для чтения — они разделяются между вызывающими.
+    
+    Фоновые запросы ограничены `max_pending`: если энкодер не успевает, embed() ждёт
+    места, а не копит неограниченный хвост запросов. Срочные запросы (`urgent=True` —
+    сообщения, на которые бот отвечает) места не ждут и забираются из очереди раньше
+    фоновых, так что ответ не стоит за хвостом фонового обогащения.
+    """
+    URGENT = 0
+    BACKGROUND = 1
+    
+    def __init__(self, encoder: Any, max_wait_ms: float = 5.0, max_batch: int = 32,
+                 cache_size: int = 4096, max_pending: int = 256):
+        self.encoder = encoder
+        self.max_pending = max_pending
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self.pending: Dict[bytes, asyncio.Future] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.sequence = itertools.count()
+        self.worker: Optional[asyncio.Task] = None
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.wait_times_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 250])
+    
+    @staticmethod
+    def cache_key(text: str) -> bytes:
+        """Ключ кэша: хэш текста без учёта регистра и лишних пробелов"""
+        normalized = " ".join(text.lower().split())
+        return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).digest()
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total else 0.0
+    
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self.cache[key] = vector
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+    
+    async def embed(self, text: str, urgent: bool = False) -> np.ndarray:
+        """Получить эмбеддинг текста (из кэша или из ближайшего батча)
+        
+        urgent=True — текст нужен для ответа прямо сейчас: он обгоняет фоновые запросы.
+        """
+        key = self.cache_key(text)
+        vector = self.cache.get(key)
+        if vector is not None:
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+            return vector
+        
+        future = self.pending.get(key)
+        if future is not None:
+            self.cache_hits += 1
+            if urgent:
+                # Тот же текст уже ждёт в фоне — ставим его ещё раз вперёд очереди
+                self._enqueue(self.URGENT, key, text, future)
+            try:
+                # shield: отмена одного ожидающего не должна отменять вектор для остальных
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Владельца future отменили до постановки в очередь — ставим текст сами
+                if future.cancelled() and self.worker is not None:
+                    return await self.embed(text, urgent)
+                raise
+        
+        self.cache_misses += 1
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.PriorityQueue()
+            self.slots = asyncio.Semaphore(self.max_pending)
+            self.worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        if urgent:
+            self._enqueue(self.URGENT, key, text, future)
+        else:
+            try:
+                await self.slots.acquire()
+            except BaseException:
+                # Отменили, пока ждали места в очереди: у future не будет производителя
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+                future.cancel()
+                raise
+            self._enqueue(self.BACKGROUND, key, text, future)
+        
+        return await asyncio.shield(future)
+    
+    def _enqueue(self, priority: int, key: bytes, text: str, future: asyncio.Future):
+        # Порядковый номер сохраняет FIFO внутри одного приоритета
+        self.queue.put_nowait((priority, next(self.sequence), key, text, future, time.perf_counter()))
+    
+    async def _collect_batch(self) -> List[Tuple[int, int, bytes, str, asyncio.Future, float]]:
+        """Дождаться первого запроса и добрать остальные в пределах окна ожидания"""
+        batch = await collect_batch(self.queue, self.max_batch, self.max_wait)
+        for priority, *_ in batch:
+            if priority == self.BACKGROUND:
+                self.slots.release()
+        # Срочные копии фоновых запросов: оставляем одну на ключ и только непосчитанные
+        unique = {}
+        for item in batch:
+            if not item[4].done():
+                unique.setdefault(item[2], item)
+        return list(unique.values())
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            
+            self.batch_sizes.observe(len(batch))
+            for *_, enqueued in batch:
+                self.wait_times_ms.observe((started - enqueued) * 1000)
+            
+            texts = [text for _, _, _, text, _, _ in batch]
+            try:
+                vectors = await loop.run_in_executor(
+                    None, lambda: self.encoder.encode(texts, batch_size=len(texts))
+                )
+            except Exception as e:
+                logger.error(f"❌ Ошибка батчевого кодирования: {e}")
+                for _, _, key, _, future, _ in batch:
+                    self.pending.pop(key, None)
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, _, key, _, future, _), vector in zip(batch, vectors):
+                vector = np.array(vector, dtype=np.float32)
+                vector.flags.writeable = False
+                self._remember(key, vector)
+                self.pending.pop(key, None)
+                if not future.done():
+                    future.set_result(vector)
+    
+    async def close(self):
+        """Остановить фоновый обработчик очереди"""
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
 
 
+# Метаданные векторов для фильтрации и ранжирования; отсутствующий топик хранится как -1
+META_DTYPE = np.dtype([('chat_id', np.int64), ('user_id', np.int64), ('thread_id', np.int64),
+                       ('timestamp', np.float64), ('importance', np.float32)])
+
+def message_meta(message: Message) -> Tuple[int, int, int, float, float]:
+    thread_id = message.thread_id if message.thread_id is not None else -1
+    return message.chat_id, message.user_id, thread_id, message.timestamp, message.importance
+
+@dataclass
+class MemoryFilter:
+    """Ограничения поиска по метаданным (None — без ограничения)"""
+    chat_id: Optional[int] = None
+    user_id: Optional[int] = None
+    thread_id: Optional[int] = None
+    since: Optional[float] = None
+    until: Optional[float] = None
+    
+    def mask(self, meta: np.ndarray) -> Optional[np.ndarray]:
+        """Битовая маска подходящих строк или None, если фильтр пустой"""
+        conditions = []
+        if self.chat_id is not None:
+            conditions.append(meta['chat_id'] == self.chat_id)
+        if self.user_id is not None:
+            conditions.append(meta['user_id'] == self.user_id)
+        if self.thread_id is not None:
+            conditions.append(meta['thread_id'] == self.thread_id)
+        if self.since is not None:
+            conditions.append(meta['timestamp'] >= self.since)
+        if self.until is not None:
+            conditions.append(meta['timestamp'] < self.until)
+        
+        if not conditions:
+            return None
+        return np.logical_and.reduce(conditions)
+    
+    def matches(self, message: Message) -> bool:
+        mask = self.mask(np.array([message_meta(message)], dtype=META_DTYPE))
+        return mask is None or bool(mask[0])
+
+@dataclass
+class RetrievalWeights:
+    """Веса итогового score воспоминания
+    
+    score = similarity * близость + importance * важность + recency * 2^(-возраст / half_life).
+    Порог MEMORY_SIMILARITY_THRESHOLD по-прежнему отсекает по чистой близости,
+    а порядок среди прошедших порог определяет взвешенная сумма.
+    """
+    similarity: float = 1.0
+    importance: float = 0.3
+    recency: float = 0.3
+    half_life_hours: float = 72.0
+    candidates_factor: int = 4  # сколько кандидатов по близости брать на одно место в выдаче
+    
+    def combine(self, similarities: np.ndarray, meta: np.ndarray,
+                now: Optional[float] = None) -> np.ndarray:
+        """Итоговые score для кандидатов с метаданными meta"""
+        now = time.time() if now is None else now
+        age_hours = np.maximum(now - meta['timestamp'], 0) / 3600
+        decay = np.exp2(-age_hours / max(self.half_life_hours, 1e-6))
+        return (self.similarity * similarities + self.importance * meta['importance']
+                + self.recency * decay).astype(np.float32)
+    
+    def rerank(self, rows: np.ndarray, similarities: np.ndarray, meta: np.ndarray,
+               k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k кандидатов по итоговому score: (rows, scores) по убыванию"""
+        scores = self.combine(similarities, meta)
+        top = top_k_above(scores, k, -np.inf)
+        return rows[top], scores[top]
+
+EMBEDDING_STORAGE_MODES = ('float32', 'float16', 'int8')
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+SWAR_MASKS = tuple(np.uint64(m) for m in (0x5555555555555555, 0x3333333333333333,
+                                          0x0F0F0F0F0F0F0F0F, 0x0101010101010101))
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Скалярное квантование в int8 с отдельным масштабом на каждый вектор"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.maximum(np.abs(vectors).max(axis=-1) / 127, 1e-12).astype(np.float32)
+    quantized = np.round(vectors / scales[..., None]).astype(np.int8)
+    return quantized, scales
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    """Расстояния Хэмминга от упакованных битовых кодов (строки uint8) до кода запроса"""
+    if codes.shape[1] % 8:
+        return POPCOUNT_TABLE[codes ^ query_code].sum(axis=1, dtype=np.uint16)
+    
+    x = np.bitwise_xor(codes.view(np.uint64), query_code.view(np.uint64))
+    if hasattr(np, 'bitwise_count'):  # NumPy 2.0+
+        return np.bitwise_count(x).sum(axis=1, dtype=np.uint16)
+    
+    # SWAR-popcount по 64-битным словам, на месте, без временных массивов на каждый шаг
+    m1, m2, m4, h01 = SWAR_MASKS
+    t = np.right_shift(x, np.uint64(1))
+    t &= m1
+    x -= t
+    np.right_shift(x, np.uint64(2), out=t)
+    t &= m2
+    x &= m2
+    x += t
+    np.right_shift(x, np.uint64(4), out=t)
+    x += t
+    x &= m4
+    x *= h01
+    x >>= np.uint64(56)
+    return x.sum(axis=1, dtype=np.uint16)
+
+class VectorBlock:
+    """Строки эмбеддингов в выбранном формате хранения
+    
+    float32 — как есть, float16 — вдвое меньше, int8 — вчетверо меньше плюс
+    4 байта масштаба на вектор. Скоринг деквантует строки кусками по
+    `SCORE_CHUNK` и считает произведение через BLAS в float32.
+    
+    float16 экономит память ценой скорости: преобразование в float32 в NumPy
+    медленное, и полный проход без префильтра примерно в 5 раз дольше float32
+    (100k векторов: ≈76 мс против ≈16 мс, `python benchmark.py quantization`).
+    С префильтром точный пересчёт идёт только по кандидатам, и разница пропадает
+    (≈5 мс у обоих) при recall@10 ≈0.99.
+    
+    С `with_signs` рядом хранятся знаковые биты (dim/8 байт на вектор, в 32 раза
+    меньше float32): поиск сначала отбирает кандидатов по расстоянию Хэмминга,
+    затем пересчитывает для них точную близость.
+    """
+    SCORE_CHUNK = 16384
+    
+    def __init__(self, capacity: int, dim: int, mode: str = 'float32', with_signs: bool = False):
+        if mode not in EMBEDDING_STORAGE_MODES:
+            raise ValueError(f"Неизвестный формат хранения эмбеддингов: {mode}")
+        self.mode = mode
+        self.dim = dim
+        dtype = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}[mode]
+        self.data = np.zeros((capacity, dim), dtype=dtype)
+        self.scales = np.ones(capacity, dtype=np.float32) if mode == 'int8' else None
+        self.signs = np.zeros((capacity, (dim + 7) // 8), dtype=np.uint8) if with_signs else None
+    
+    def __len__(self) -> int:
+        return len(self.data)
+    
+    @property
+    def bytes_per_vector(self) -> int:
+        size = self.data.itemsize * self.dim
+        if self.scales is not None:
+            size += self.scales.itemsize
+        if self.signs is not None:
+            size += self.signs.shape[1]
+        return size
+    
+    def write(self, start: int, vectors: np.ndarray):
+        """Записать нормированные float32-векторы начиная со строки start"""
+        end = start + len(vectors)
+        if self.mode == 'int8':
+            self.data[start:end], self.scales[start:end] = quantize_int8(vectors)
+        else:
+            self.data[start:end] = vectors
+        if self.signs is not None:
+            self.signs[start:end] = np.packbits(vectors > 0, axis=1)
+    
+    def _subset(self, rows: Any, capacity: int) -> "VectorBlock":
+        block = VectorBlock(capacity, self.dim, self.mode, self.signs is not None)
+        count = len(self.data[rows])
+        block.data[:count] = self.data[rows]
+        if self.scales is not None:
+            block.scales[:count] = self.scales[rows]
+        if self.signs is not None:
+            block.signs[:count] = self.signs[rows]
+        return block
+    
+    def grown(self, size: int, capacity: int) -> "VectorBlock":
+        """Новый блок большей ёмкости с копией первых size строк"""
+        return self._subset(slice(0, size), capacity)
+    
+    def take(self, rows: np.ndarray) -> "VectorBlock":
+        """Новый блок из выбранных строк"""
+        return self._subset(rows, len(rows))
+    
+    def to_float32(self, size: int, start: int = 0) -> np.ndarray:
+        """Строки [start, size) в float32"""
+        vectors = self.data[start:size].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[start:size, None]
+        return vectors
+    
+    def scores(self, query: np.ndarray, size: int) -> np.ndarray:
+        """Близость запроса ко всем строкам [0, size)"""
+        if self.mode == 'float32':
+            return self.data[:size] @ query
+        
+        scores = np.empty(size, dtype=np.float32)
+        for start in range(0, size, self.SCORE_CHUNK):
+            end = min(start + self.SCORE_CHUNK, size)
+            scores[start:end] = self.data[start:end].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[:size]
+        return scores
+    
+    def scores_at(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Близость запроса к выбранным строкам"""
+        scores = self.data[rows].astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales[rows]
+        return scores
+    
+    def search(self, query: np.ndarray, size: int, k: int, threshold: float,
+               rerank_factor: int = 20,
+               rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k строк выше порога: (номера строк, близости) по убыванию
+        
+        rows — заранее отфильтрованное подмножество строк: скоринг идёт только по нему.
+        """
+        candidates_count = k * rerank_factor
+        total = size if rows is None else len(rows)
+        if self.signs is not None and total > candidates_count:
+            signs = self.signs[:size] if rows is None else self.signs[rows]
+            distances = hamming_distances(signs, np.packbits(query > 0))
+            candidates = np.argpartition(distances, candidates_count - 1)[:candidates_count]
+            if rows is not None:
+                candidates = rows[candidates]
+            scores = self.scores_at(query, candidates)
+            top = top_k_above(scores, k, threshold)
+            return candidates[top], scores[top]
+        
+        if rows is not None:
+            scores = self.scores_at(query, rows)
+            top = top_k_above(scores, k, threshold)
+            return rows[top], scores[top]
+        
+        scores = self.scores(query, size)
+        top = top_k_above(scores, k, threshold)
+        return top, scores[top]
 
 # === ОСТАЛЬНЫЕ КЛАССЫ (VectorMemory, DatabaseManager, AdvancedContextManager) ===
 # Оставляю их без изменений, они слишком большие для повторной вставки
 class VectorMemory:
-    """Векторная память для поиска релевантных сообщений"""
-    def __init__(self, embedding_model: str):
-        self.encoder = SentenceTransformer(embedding_model)
-        self.embeddings = []
-        self.messages = []
+    """Векторная память для поиска релевантных сообщений
+    
+    Эмбеддинги хранятся в заранее выделенном блоке фиксированной ёмкости (float32,
+    float16 или int8 — см. VectorBlock), запись идёт по кольцу через курсор.
+    Поиск — один матричный проход по непрерывному срезу.
+    
+    Кодирование текста выполняется вне блокировки, под lock'ом — только запись строки.
+    Читатели блокировку не берут: они фиксируют счётчик записей `written` до поиска и
+    отбрасывают слоты, перезаписанные за время поиска, и слот, который пишется в момент
+    проверки (seqlock-подобная схема).
+    """
+    def __init__(self, embedding_model: str, capacity: int = 1000, encoder: Any = None,
+                 embedding_service: Optional[EmbeddingService] = None, storage: str = 'float32',
+                 binary_prefilter: bool = False, rerank_factor: int = 20):
+        self.encoder = encoder if encoder is not None else SentenceTransformer(embedding_model)
+        self.embedding_service = embedding_service
+        self.capacity = capacity
+        self.rerank_factor = rerank_factor
+        self.dim = self.encoder.get_sentence_embedding_dimension()
+        self.block = VectorBlock(capacity, self.dim, storage, binary_prefilter)
+        self.meta = np.zeros(capacity, dtype=META_DTYPE)
+        self.messages: List[Optional[Message]] = [None] * capacity
+        self.written = 0  # сколько записей сделано за всё время; курсор = written % capacity
         self.lock = threading.Lock()
     
+    def __len__(self) -> int:
+        return min(self.written, self.capacity)
+    
+    @staticmethod
+    def text_for_embedding(message: Message) -> str:
+        text_for_embedding = message.text
+        if message.image_description:
+            text_for_embedding += f" [КАРТИНКА: {message.image_description}]"
+        return text_for_embedding
+    
     def add_message(self, message: Message):
         """Добавить сообщение в векторную память"""
         try:
-            with self.lock:
-                text_for_embedding = message.text
-                if message.image_description:
-                    text_for_embedding += f" [КАРТИНКА: {message.image_description}]"
-                
-                embedding = self.encoder.encode([text_for_embedding])[0]
-                self.embeddings.append(embedding)
-                self.messages.append(message)
-                
-                if len(self.embeddings) > 1000:
-                    self.embeddings = self.embeddings[-1000:]
-                    self.messages = self.messages[-1000:]
+            embedding = self.encoder.encode([self.text_for_embedding(message)])[0]
+            self.add_embedding(message, embedding)
         except Exception as e:
             logger.error(f"❌ Ошибка добавления в векторную память: {e}")
     
+    async def add_message_async(self, message: Message):
+        """Добавить сообщение, не блокируя event loop на кодировании"""
+        if self.embedding_service is None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.add_message, message)
+            return
+        
+        try:
+            embedding = message.embedding
+            if embedding is None:
+                embedding = await self.embedding_service.embed(self.text_for_embedding(message))
+            self.add_embedding(message, embedding)
+        except Exception as e:
+            logger.error(f"❌ Ошибка добавления в векторную память: {e}")
+    
+    def add_embedding(self, message: Message, embedding: np.ndarray):
+        """Записать готовый эмбеддинг в кольцо (самая старая запись перезаписывается)"""
+        # Нормируем при вставке, чтобы порог поиска был порогом косинусной близости
+        embedding = l2_normalize(embedding).reshape(1, -1)
+        with self.lock:
+            slot = self.written % self.capacity
+            self.block.write(slot, embedding)
+            self.meta[slot] = message_meta(message)
+            self.messages[slot] = message
+            # Публикуем запись только после того, как слот полностью заполнен
+            self.written += 1
+    
     def search_similar(self, query: str, limit: int = 5) -> List[Message]:
         """Поиск похожих сообщений"""
         try:
-            if not self.embeddings:
+            if not self.written:
                 return []
             
-            with self.lock:
-                query_embedding = self.encoder.encode([query])[0]
-                similarities = np.dot(self.embeddings, query_embedding)
-                top_indices = np.argsort(similarities)[-limit:][::-1]
-                
-                return [self.messages[i] for i in top_indices if similarities[i] > 0.3]
+            query_embedding = self.encoder.encode([query])[0]
+            return self.search_by_vector(query_embedding, limit)
+        except Exception as e:
+            logger.error(f"❌ Ошибка поиска в векторной памяти: {e}")
+            return []
+    
+    async def search_similar_async(self, query: str, limit: int = 5) -> List[Message]:
+        """Поиск похожих сообщений без блокировки event loop"""
+        if self.embedding_service is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.search_similar, query, limit)
+        
+        try:
+            if not self.written:
+                return []
+            
+            query_embedding = await self.embedding_service.embed(query, urgent=True)
+            return self.search_by_vector(query_embedding, limit)
         except Exception as e:
             logger.error(f"❌ Ошибка поиска в векторной памяти: {e}")
             return []
+    
+    def search_by_vector(self, query_embedding: np.ndarray, limit: int = 5) -> List[Message]:
+        """Поиск по готовому эмбеддингу запроса (без блокировки)"""
+        return [msg for _, msg in self.search_scored(query_embedding, limit)]
+    
+    def search_scored(self, query_embedding: np.ndarray, limit: int = 5,
+                      memory_filter: Optional[MemoryFilter] = None,
+                      weights: Optional[RetrievalWeights] = None) -> List[Tuple[float, Message]]:
+        """Поиск по эмбеддингу: пары (score, сообщение) по убыванию score
+        
+        Фильтр по метаданным применяется маской до скоринга — скалярные
+        произведения считаются только для подходящих строк. Без weights score —
+        косинусная близость, с ними — взвешенная сумма с важностью и свежестью.
+        """
+        written = self.written
+        size = min(written, self.capacity)
+        if not size:
+            return []
+        
+        rows = None
+        mask = memory_filter.mask(self.meta[:size]) if memory_filter is not None else None
+        if mask is not None:
+            rows = np.flatnonzero(mask)
+            if not len(rows):
+                return []
+        
+        # Пока кольцо не заполнено, занятые слоты — это префикс матрицы
+        candidates = limit * weights.candidates_factor if weights is not None else limit
+        rows, scores = self.block.search(
+            l2_normalize(query_embedding), size, candidates,
+            Constants.MEMORY_SIMILARITY_THRESHOLD, self.rerank_factor, rows
+        )
+        if weights is not None:
+            rows, scores = weights.rerank(rows, scores, self.meta[rows], limit)
+        hits = [(score, i, self.messages[i]) for i, score in zip(rows.tolist(), scores.tolist())]
+        
+        # Слоты, перезаписанные писателем во время поиска, могли быть прочитаны наполовину.
+        # Счётчик проверяется после чтения сообщений; +1 — слот, который пишется прямо
+        # сейчас: его вектор уже может быть новым, а сообщение — ещё старым
+        overwritten = self.written - written
+        stale = {(written + j) % self.capacity for j in range(min(overwritten + 1, self.capacity))}
+        hits = [hit for hit in hits if hit[1] not in stale]
+        
+        return [(score, msg) for score, _, msg in hits]
+
+@dataclass
+class IVFState:
+    """Снимок IVF-индекса: читатели работают с ним без блокировки"""
+    centroids: Optional[np.ndarray]  # None — индекс ещё не обучен, один плоский список
+    lists: List[Tuple[VectorBlock, np.ndarray, np.ndarray]]  # (векторы, ids, метаданные) — подменяются целиком
+    sizes: List[int]
+
+class IVFIndex:
+    """Приближённый поиск ближайших соседей (IVF-Flat) на чистом NumPy
+    
+    Векторы нормируются при вставке, score — косинусная близость. Списки хранятся
+    в VectorBlock, так что квантование и бинарный префильтр работают и здесь.
+    Векторы раскладываются по `nlist` кластерам (сферический k-means), поиск
+    просматривает только `nprobe` ближайших кластеров. Пока векторов меньше
+    `train_threshold`, индекс работает как точный плоский поиск. Когда объём
+    вырастает в `retrain_factor` раз с момента обучения, кластеры пересчитываются.
+    
+    Вставки дописывают строки в конец списков (массивы растут удвоением), поэтому
+    читатель, прочитавший сначала размер списка, а потом массив, всегда видит
+    целые строки. Переобучение идёт в фоновом потоке по снимку: вставки и поиск
+    его не ждут, векторы, добавленные за это время, докладываются в новый снимок,
+    и он подменяет старый целиком. Удаление тоже публикует новый снимок.
+    """
+    RETRAIN_CHUNK = 65536
+    CATCH_UP_UNDER_LOCK = 10000  # сколько догоняющих векторов можно разложить под блокировкой
+    def __init__(self, dim: int, nprobe: int = 4, nlist: int = 0,
+                 train_threshold: int = 10000, retrain_factor: int = 4, storage: str = 'float32',
+                 binary_prefilter: bool = False, rerank_factor: int = 20):
+        self.dim = dim
+        self.storage = storage
+        self.binary_prefilter = binary_prefilter
+        self.rerank_factor = rerank_factor
+        self.nprobe = nprobe
+        self.nlist = nlist  # 0 — подобрать автоматически (≈ sqrt(N))
+        self.train_threshold = train_threshold
+        self.retrain_factor = retrain_factor
+        self.trained_size = 0
+        self.min_id = 0  # векторы с меньшими ids удалены (drop_ids_below)
+        self.state = IVFState(None, [self._empty_list()], [0])
+        self.lock = threading.Lock()
+        self.retrain_thread: Optional[threading.Thread] = None
+        # Вставки во время переобучения: их нет в снимке, по которому строится новый индекс
+        self.added_during_retrain: Optional[List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = None
+    
+    def __len__(self) -> int:
+        return sum(self.state.sizes)
+    
+    def add(self, ids: np.ndarray, vectors: np.ndarray, meta: Optional[np.ndarray] = None):
+        """Добавить векторы с идентификаторами (rowid из таблицы messages)
+        
+        meta — массив META_DTYPE той же длины для фильтрации при поиске.
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        vectors = l2_normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        if not len(ids):
+            return
+        if meta is None:
+            meta = np.zeros(len(ids), dtype=META_DTYPE)
+            meta['thread_id'] = -1
+        
+        with self.lock:
+            self._add_to_state(self.state, ids, vectors, meta)
+            if self.added_during_retrain is not None:
+                self.added_during_retrain.append((ids, vectors, meta))
+            elif self._needs_retrain():
+                self.added_during_retrain = []
+                self.retrain_thread = threading.Thread(target=self._retrain, name="ivf-retrain", daemon=True)
+                self.retrain_thread.start()
+    
+    def _needs_retrain(self) -> bool:
+        total = sum(self.state.sizes)
+        if self.state.centroids is None:
+            return total >= self.train_threshold
+        return total >= self.trained_size * self.retrain_factor
+    
+    def wait_for_retrain(self, timeout: Optional[float] = None):
+        """Дождаться фонового переобучения
+        
+        Массовая загрузка зовёт это между пачками: иначе вся история копится
+        в added_during_retrain второй копией в RAM.
+        """
+        thread = self.retrain_thread
+        if thread is not None:
+            thread.join(timeout)
+    
+    @classmethod
+    def _add_to_state(cls, state: IVFState, ids: np.ndarray, vectors: np.ndarray, meta: np.ndarray):
+        if state.centroids is None:
+            cls._append(state, 0, ids, vectors, meta)
+            return
+        assignment = np.argmax(vectors @ state.centroids.T, axis=1)
+        for list_no in np.unique(assignment):
+            mask = assignment == list_no
+            cls._append(state, int(list_no), ids[mask], vectors[mask], meta[mask])
+    
+    def _empty_list(self) -> Tuple[VectorBlock, np.ndarray, np.ndarray]:
+        return (VectorBlock(0, self.dim, self.storage, self.binary_prefilter),
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=META_DTYPE))
+    
+    @staticmethod
+    def _append(state: IVFState, list_no: int, ids: np.ndarray, vectors: np.ndarray,
+                meta: np.ndarray):
+        size = state.sizes[list_no]
+        needed = size + len(ids)
+        block, list_ids, list_meta = state.lists[list_no]
+        if needed > len(list_ids):
+            capacity = max(needed, 2 * len(list_ids), 16)
+            grown_ids = np.zeros(capacity, dtype=np.int64)
+            grown_ids[:size] = list_ids[:size]
+            grown_meta = np.zeros(capacity, dtype=META_DTYPE)
+            grown_meta[:size] = list_meta[:size]
+            block, list_ids, list_meta = block.grown(size, capacity), grown_ids, grown_meta
+            state.lists[list_no] = (block, list_ids, list_meta)
+        
+        block.write(size, vectors)
+        list_ids[size:needed] = ids
+        list_meta[size:needed] = meta
+        # Размер публикуется последним — читатель не увидит недописанных строк
+        state.sizes[list_no] = needed
+    
+    def _retrain(self):
+        """Переобучение в фоне: k-means по снимку, раскладка, догоняющие вставки, подмена
+        
+        Блокировка берётся только на снимок и на подмену: префиксы списков в снимке
+        уже не меняются (вставки пишут дальше, удаление создаёт новые массивы).
+        """
+        try:
+            while True:
+                with self.lock:
+                    state = self.state
+                    lists, sizes = list(state.lists), list(state.sizes)
+                    self.added_during_retrain = []  # всё, что раньше, уже в снимке
+                
+                started = time.time()
+                total = sum(sizes)
+                nlist = self.nlist or int(np.clip(np.sqrt(total), 16, 4096))
+                centroids = self._kmeans(self._sample(lists, sizes, nlist * 40), nlist)
+                
+                new_state = IVFState(centroids, [self._empty_list() for _ in range(nlist)], [0] * nlist)
+                for (block, list_ids, list_meta), size in zip(lists, sizes):
+                    for start in range(0, size, self.RETRAIN_CHUNK):
+                        end = min(start + self.RETRAIN_CHUNK, size)
+                        self._add_to_state(new_state, list_ids[start:end],
+                                           block.to_float32(end, start), list_meta[start:end])
+                
+                # Пока догоняющих много, раскладываем их без блокировки
+                while True:
+                    with self.lock:
+                        added = self.added_during_retrain
+                        if sum(len(ids) for ids, _, _ in added) <= self.CATCH_UP_UNDER_LOCK:
+                            for ids, vectors, meta in added:
+                                self._add_to_state(new_state, ids, vectors, meta)
+                            if self.min_id:
+                                new_state = self._without_ids_below(new_state, self.min_id)
+                            self.state = new_state
+                            self.trained_size = total
+                            self.added_during_retrain = [] if self._needs_retrain() else None
+                            break
+                        self.added_during_retrain = []
+                    for ids, vectors, meta in added:
+                        self._add_to_state(new_state, ids, vectors, meta)
+                
+                logger.info(f"🗂️ IVF-индекс переобучен: {total} векторов, {nlist} кластеров "
+                            f"за {time.time() - started:.1f}с")
+                # Пока шло обучение, индекс мог вырасти ещё в retrain_factor раз
+                if self.added_during_retrain is None:
+                    break
+        except Exception as e:
+            logger.error(f"❌ Ошибка переобучения IVF-индекса: {e}")
+            with self.lock:
+                self.added_during_retrain = None
+    
+    def _sample(self, lists: List[Tuple[VectorBlock, np.ndarray, np.ndarray]], sizes: List[int],
+                sample_size: int) -> np.ndarray:
+        """Случайная подвыборка векторов снимка для k-means (без копии всего индекса)"""
+        total = sum(sizes)
+        rng = np.random.default_rng(0)
+        rows = np.sort(rng.choice(total, min(sample_size, total), replace=False))
+        offsets = np.cumsum([0] + sizes)
+        parts = []
+        for list_no, (block, _, _) in enumerate(lists):
+            lo, hi = np.searchsorted(rows, offsets[list_no:list_no + 2])
+            if hi > lo:
+                parts.append(block.take(rows[lo:hi] - offsets[list_no]).to_float32(hi - lo))
+        return np.concatenate(parts)
+    
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        """Номер ближайшего центроида для каждого вектора (кусками, чтобы не раздувать RAM)"""
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            scores = vectors[start:start + chunk] @ centroids.T
+            assignment[start:start + chunk] = np.argmax(scores, axis=1)
+        return assignment
+    
+    @classmethod
+    def _kmeans(cls, vectors: np.ndarray, nlist: int, iterations: int = 10,
+                sample_per_list: int = 40) -> np.ndarray:
+        """Сферический k-means по подвыборке"""
+        rng = np.random.default_rng(0)
+        sample_size = min(len(vectors), nlist * sample_per_list)
+        sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        sample = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+        
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = cls._assign(sample, centroids)
+            counts = np.bincount(assignment, minlength=nlist)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            filled = counts > 0
+            sums = np.zeros_like(centroids)
+            sums[filled] = np.add.reduceat(
+                sample[np.argsort(assignment, kind='stable')], starts[filled], axis=0
+            )
+            # Пустые кластеры пересеиваем случайными точками
+            if not filled.all():
+                sums[~filled] = sample[rng.choice(sample_size, int((~filled).sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        return centroids.astype(np.float32)
+    
+    def search(self, query: np.ndarray, k: int = 5, threshold: float = -1.0,
+               memory_filter: Optional[MemoryFilter] = None,
+               weights: Optional[RetrievalWeights] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k по косинусной близости выше порога: (ids, scores), по убыванию score
+        
+        С фильтром в каждом просматриваемом списке скорятся только строки,
+        прошедшие маску по метаданным. С weights кандидаты выше порога
+        переранжируются по взвешенному score (RetrievalWeights).
+        """
+        candidates = k * weights.candidates_factor if weights is not None else k
+        state = self.state
+        query = l2_normalize(query)
+        
+        if state.centroids is None:
+            probe = [0]
+        else:
+            nprobe = min(self.nprobe, len(state.sizes))
+            centroid_scores = state.centroids @ query
+            probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        
+        score_parts, id_parts, meta_parts = [], [], []
+        for list_no in probe:
+            size = state.sizes[list_no]
+            if size:
+                block, list_ids, list_meta = state.lists[list_no]
+                rows = None
+                if memory_filter is not None:
+                    mask = memory_filter.mask(list_meta[:size])
+                    if mask is not None:
+                        rows = np.flatnonzero(mask)
+                        if not len(rows):
+                            continue
+                rows, scores = block.search(query, size, candidates, threshold,
+                                            self.rerank_factor, rows)
+                score_parts.append(scores)
+                id_parts.append(list_ids[rows])
+                meta_parts.append(list_meta[rows])
+        
+        if not score_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        
+        scores = np.concatenate(score_parts)
+        ids = np.concatenate(id_parts)
+        if weights is not None:
+            return weights.rerank(ids, scores, np.concatenate(meta_parts), k)
+        top = top_k_above(scores, k, threshold)
+        return ids[top], scores[top]
+    
+    def drop_ids_below(self, min_id: int):
+        """Выкинуть векторы удалённых из БД сообщений (rowid растут со временем)"""
+        with self.lock:
+            self.min_id = max(self.min_id, min_id)
+            self.state = self._without_ids_below(self.state, self.min_id)
+    
+    @staticmethod
+    def _without_ids_below(state: IVFState, min_id: int) -> IVFState:
+        """Новый снимок без векторов с ids < min_id
+        
+        Списки и размеры подменяются вместе: читатель, взявший старый снимок,
+        не увидит размер одного списка рядом с массивами другого.
+        """
+        lists, sizes = list(state.lists), list(state.sizes)
+        for list_no, size in enumerate(sizes):
+            block, list_ids, list_meta = lists[list_no]
+            keep = np.flatnonzero(list_ids[:size] >= min_id)
+            if len(keep) == size:
+                continue
+            lists[list_no] = (block.take(keep), list_ids[keep], list_meta[keep])
+            sizes[list_no] = len(keep)
+        return IVFState(state.centroids, lists, sizes)
+
+class VectorLog:
+    """Журнал эмбеддингов только на дозапись: по сегменту на период времени
+    
+    Сегмент — три сырых файла с одинаковым числом строк: `<period>.vec`
+    (float32 × dim), `<period>.ids` (int64 rowid) и `<period>.meta` (META_DTYPE).
+    Читатели открывают их через np.memmap на уже дописанное число строк, поэтому
+    полный проход по истории идёт из page cache без Python-объекта на строку.
+    Ретеншн удаляет сегменты целиком, а не строки.
+    
+    Три файла дописываются по очереди, так что падение посреди append оставляет
+    их разной длины (или вовсе без .ids у нового сегмента). При открытии журнала (и после ошибки записи) файлы сегмента
+    обрезаются до общего числа целых строк — иначе следующие дозаписи навсегда
+    сдвинули бы векторы относительно ids.
+    """
+    SCAN_CHUNK = 65536
+    
+    def __init__(self, directory: str, dim: int, period_days: int = 7):
+        self.directory = directory
+        self.dim = dim
+        self.period = max(period_days, 1) * 86400
+        self.record_sizes = {'vec': 4 * dim, 'ids': 8, 'meta': META_DTYPE.itemsize}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            for segment in self.segments():
+                self._repair(segment)
+    
+    def _path(self, segment: int, kind: str) -> str:
+        return os.path.join(self.directory, f"{segment}.{kind}")
+    
+    def _repair(self, segment: int):
+        """Обрезать файлы сегмента до общего числа целых строк"""
+        sizes = {}
+        for kind in self.record_sizes:
+            try:
+                sizes[kind] = os.path.getsize(self._path(segment, kind))
+            except FileNotFoundError:
+                sizes[kind] = 0
+        rows = min(sizes[kind] // record for kind, record in self.record_sizes.items())
+        for kind, record in self.record_sizes.items():
+            if sizes[kind] != rows * record:
+                with open(self._path(segment, kind), 'ab') as f:
+                    f.truncate(rows * record)
+                logger.warning(f"📼 Сегмент {segment}.{kind} обрезан до {rows} строк после незавершённой записи")
+    
+    def segments(self) -> List[int]:
+        """Номера сегментов по возрастанию (номер = начало периода // длина периода)
+        
+        Сегмент находится по любому из трёх файлов: падение на первой дозаписи в новый
+        сегмент оставляет .vec/.meta без .ids, и их тоже нужно найти и обрезать.
+        """
+        segments = set()
+        for name in os.listdir(self.directory):
+            stem, _, kind = name.rpartition('.')
+            if kind in self.record_sizes and stem.lstrip('-').isdigit():
+                segments.add(int(stem))
+        return sorted(segments)
+    
+    def append(self, ids: np.ndarray, vectors: np.ndarray, meta: np.ndarray):
+        """Дописать нормированные векторы; сегмент выбирается по timestamp"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        vectors = l2_normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        segments = (meta['timestamp'] // self.period).astype(np.int64)
+        with self.lock:
+            for segment in np.unique(segments):
+                mask = segments == segment
+                try:
+                    # ids пишутся последними: по ним читатель считает готовые строки
+                    for kind, data in (('vec', vectors[mask]), ('meta', meta[mask]), ('ids', ids[mask])):
+                        with open(self._path(int(segment), kind), 'ab') as f:
+                            f.write(np.ascontiguousarray(data).tobytes())
+                except OSError:
+                    self._repair(int(segment))
+                    raise
+    
+    def _open(self, segment: int) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Отобразить сегмент в память: (векторы, ids, метаданные) или None для пустого"""
+        try:
+            rows = min(os.path.getsize(self._path(segment, kind)) // record
+                       for kind, record in self.record_sizes.items())
+        except OSError:
+            return None
+        if not rows:
+            return None
+        return (
+            np.memmap(self._path(segment, 'vec'), np.float32, 'r', shape=(rows, self.dim)),
+            np.memmap(self._path(segment, 'ids'), np.int64, 'r', shape=(rows,)),
+            np.memmap(self._path(segment, 'meta'), META_DTYPE, 'r', shape=(rows,)),
+        )
+    
+    def iter_segments(self):
+        """Выдать (ids, векторы, метаданные) каждого непустого сегмента"""
+        for segment in self.segments():
+            opened = self._open(segment)
+            if opened is not None:
+                vectors, ids, meta = opened
+                yield ids, vectors, meta
+    
+    def ids(self) -> np.ndarray:
+        """Все записанные rowid, отсортированные и без повторов"""
+        parts = [np.asarray(ids) for ids, _, _ in self.iter_segments()]
+        return np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+    
+    def __len__(self) -> int:
+        return sum(len(ids) for ids, _, _ in self.iter_segments())
+    
+    def search(self, query: np.ndarray, k: int = 5, threshold: float = -1.0,
+               memory_filter: Optional[MemoryFilter] = None,
+               weights: Optional[RetrievalWeights] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Точный поиск по всей истории: (ids, scores) по убыванию score"""
+        query = l2_normalize(query)
+        candidates = k * weights.candidates_factor if weights is not None else k
+        score_parts, id_parts, meta_parts = [], [], []
+        for ids, vectors, meta in self.iter_segments():
+            for start in range(0, len(ids), self.SCAN_CHUNK):
+                end = min(start + self.SCAN_CHUNK, len(ids))
+                rows = np.arange(start, end)
+                if memory_filter is not None:
+                    mask = memory_filter.mask(meta[start:end])
+                    if mask is not None:
+                        rows = rows[mask]
+                if not len(rows):
+                    continue
+                chunk = vectors[start:end] if len(rows) == end - start else vectors[rows]
+                scores = chunk @ query
+                top = top_k_above(scores, candidates, threshold)
+                score_parts.append(scores[top])
+                id_parts.append(np.asarray(ids[rows[top]]))
+                meta_parts.append(np.asarray(meta[rows[top]]))
+        
+        if not score_parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        
+        scores = np.concatenate(score_parts)
+        ids = np.concatenate(id_parts)
+        if weights is not None:
+            return weights.rerank(ids, scores, np.concatenate(meta_parts), k)
+        top = top_k_above(scores, k, threshold)
+        return ids[top], scores[top]
+    
+    def drop_before(self, cutoff: float) -> int:
+        """Удалить сегменты, целиком лежащие раньше cutoff; вернуть их число"""
+        dropped = 0
+        with self.lock:
+            for segment in self.segments():
+                if (segment + 1) * self.period > cutoff:
+                    continue
+                for kind in ('ids', 'vec', 'meta'):
+                    try:
+                        os.remove(self._path(segment, kind))
+                    except FileNotFoundError:
+                        pass
+                dropped += 1
+        return dropped
 
 class DatabaseManager:
-    """Управление SQLite базой данных с поддержкой изображений"""
-    def __init__(self, db_path: str):
+    """Управление SQLite базой данных с поддержкой изображений
+
+    Соединения долгоживущие: одно пишущее под замком и по читающему на поток.
+    База в режиме WAL, так что чтения не ждут записи, а synchronous=NORMAL
+    делает fsync только при чекпоинте, а не на каждый коммит.
+    """
+    def __init__(self, db_path: str, embedding_storage: str = 'float32',
+                 cache_size_mb: int = 64, mmap_size_mb: int = 256, embedding_model: str = ''):
         self.db_path = db_path
+        self.embedding_storage = embedding_storage
+        self.embedding_model = embedding_model
+        self.cache_size_mb = cache_size_mb
+        self.mmap_size_mb = mmap_size_mb
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+        self.readers: List[sqlite3.Connection] = []
+        self.write_conn = self._connect()
         self.init_database()
     
+    def _connect(self) -> sqlite3.Connection:
+        """Открыть соединение с настроенными прагмами"""
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        # Действует только на новой базе (до первой таблицы); старую переводит tools.py vacuum
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{self.cache_size_mb * 1024}')
+        conn.execute(f'PRAGMA mmap_size={self.mmap_size_mb * 1024 * 1024}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    @contextmanager
+    def writer(self):
+        """Пишущее соединение: одна транзакция под замком, commit или rollback на выходе"""
+        with self.write_lock, self.write_conn:
+            yield self.write_conn
+    
+    @contextmanager
+    def reader(self):
+        """Читающее соединение текущего потока (открывается при первом обращении)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+            with self.write_lock:
+                self.readers.append(conn)
+        yield conn
+    
+    def close(self):
+        """Закрыть все соединения (WAL сбрасывается в основной файл при закрытии последнего)"""
+        with self.write_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers.clear()
+            self.write_conn.close()
+    
     def init_database(self):
         """Инициализация базы данных"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.writer() as conn:
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -397,7 +1871,10 @@ class DatabaseManager:
                     importance REAL,
                     embedding BLOB,
                     has_image BOOLEAN DEFAULT FALSE,
-                    image_description TEXT
+                    image_description TEXT,
+                    thread_id INTEGER,
+                    embedding_dim INTEGER,
+                    embedding_model TEXT
                 )
             ''')
             
@@ -407,6 +1884,12 @@ class DatabaseManager:
             except sqlite3.OperationalError:
                 pass
             
+            for column in ('thread_id INTEGER', 'embedding_dim INTEGER', 'embedding_model TEXT'):
+                try:
+                    cursor.execute(f'ALTER TABLE messages ADD COLUMN {column}')
+                except sqlite3.OperationalError:
+                    pass
+            
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_profiles (
                     user_id INTEGER PRIMARY KEY,
@@ -419,42 +1902,194 @@ class DatabaseManager:
                 )
             ''')
             
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON messages(user_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON messages(timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_id ON messages(chat_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_has_image ON messages(has_image)')
-            
-            conn.commit()
-    
-    def save_message(self, message: Message, embedding: Optional[np.ndarray] = None):
-        """Сохранить сообщение в БД"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+            for column in ('interest_vector BLOB', 'interest_samples INTEGER DEFAULT 0',
+                           'interest_centroids BLOB', 'interest_labels BLOB'):
+                try:
+                    cursor.execute(f'ALTER TABLE user_profiles ADD COLUMN {column}')
+                except sqlite3.OperationalError:
+                    pass
             
-            embedding_blob = pickle.dumps(embedding) if embedding is not None else None
+            # Запросы фильтруют по автору и сортируют по времени — составной индекс покрывает
+            # и фильтр, и сортировку; has_image с двумя значениями индекс не нужен. По чату
+            # фильтруют только векторная память и FTS (после поиска), индекс по чату не читается
+            for old_index in ('idx_user_id', 'idx_chat_id', 'idx_has_image', 'idx_chat_time'):
+                cursor.execute(f'DROP INDEX IF EXISTS {old_index}')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_time ON messages(user_id, timestamp)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON messages(timestamp)')
+            # Только rowid строк с эмбеддингом: сверка с журналом векторов без чтения таблицы
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_embedded ON messages(id) WHERE embedding IS NOT NULL')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_profiles_last_seen ON user_profiles(last_seen)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_profiles_relationship ON user_profiles(relationship_level)')
             
-            cursor.execute('''
-                INSERT INTO messages 
-                (user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
-                 sentiment, importance, embedding, has_image, image_description)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                message.user_id, message.username, message.text, message.timestamp,
-                message.chat_id, message.message_id, message.is_reply, message.reply_to_user,
-                message.sentiment, message.importance, embedding_blob,
-                message.has_image, message.image_description
-            ))
             conn.commit()
+        
+        self.has_fts = self._init_fts()
+    
+    def _init_fts(self) -> bool:
+        """Полнотекстовый индекс messages_fts (FTS5, external content) с триггерами
+        
+        Индекс хранит только токены, текст читается из messages. Триггеры держат
+        его в синхронизации со вставками, удалениями ретеншна и правками текста.
+        При первом создании индекс заполняется по всей истории. Без FTS5 в сборке
+        SQLite поиск по ключевым словам просто выключается.
+        """
+        try:
+            with self.writer() as conn:
+                exists = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+                ).fetchone()
+                # tokenchars '_': идентификаторы из кода (get_user_profile) остаются одним токеном
+                conn.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                        text, content='messages', content_rowid='id',
+                        tokenize="unicode61 remove_diacritics 2 tokenchars '_'"
+                    )
+                ''')
+                conn.execute('''
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+                    END
+                ''')
+                conn.execute('''
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                    END
+                ''')
+                conn.execute('''
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+                    END
+                ''')
+                if not exists:
+                    started = time.time()
+                    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+                    logger.info(f"🔤 Полнотекстовый индекс построен за {time.time() - started:.1f}с")
+            return True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"⚠️ FTS5 недоступен, поиск по ключевым словам выключен: {e}")
+            return False
+    
+    # Все запросы чтения и пакетного удаления по имени: check_query_plans проверяет
+    # каждый через EXPLAIN QUERY PLAN, так что новый запрос добавляйте сюда
+    QUERIES = {
+        'user_history': '''
+            SELECT user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
+                   sentiment, importance, has_image, image_description
+            FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
+        ''',
+        'recent_messages': '''
+            SELECT user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
+                   sentiment, importance, has_image, image_description, embedding, thread_id,
+                   embedding_dim
+            FROM messages ORDER BY timestamp DESC LIMIT ?
+        ''',
+        'legacy_embeddings': 'SELECT id, embedding FROM messages WHERE id > ? AND embedding IS NOT NULL '
+                             'AND embedding_dim IS NULL ORDER BY id LIMIT ?',
+        'migrate_embedding': 'UPDATE messages SET embedding = ?, embedding_dim = ?, embedding_model = ? '
+                             'WHERE id = ? AND embedding_dim IS NULL',
+        # Два подзапроса: MIN и MAX вместе в одном SELECT сканируют индекс целиком
+        'message_id_range': 'SELECT (SELECT MIN(id) FROM messages), (SELECT MAX(id) FROM messages)',
+        'embeddings_page': 'SELECT id, embedding, chat_id, user_id, thread_id, timestamp, importance, embedding_dim '
+                           'FROM messages WHERE id > ? AND id <= ? AND embedding IS NOT NULL ORDER BY id LIMIT ?',
+        'embedded_ids': 'SELECT id FROM messages WHERE id > ? AND id <= ? AND embedding IS NOT NULL ORDER BY id',
+        'embeddings_by_ids': 'SELECT id, embedding, chat_id, user_id, thread_id, timestamp, importance, embedding_dim '
+                             'FROM messages WHERE id IN ({placeholders}) AND embedding IS NOT NULL ORDER BY id',
+        'messages_by_ids': '''
+            SELECT id, user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
+                   sentiment, importance, has_image, image_description, thread_id
+            FROM messages WHERE id IN ({placeholders})
+        ''',
+        'user_embeddings': 'SELECT text, embedding, embedding_dim, chat_id FROM messages WHERE user_id = ? '
+                           'AND embedding IS NOT NULL ORDER BY timestamp DESC LIMIT ?',
+        'expired_id_range': 'SELECT MIN(id), MAX(id) FROM messages WHERE timestamp < ?',
+        'expired_batch': 'SELECT {columns} FROM messages WHERE id BETWEEN ? AND ? AND timestamp < ?',
+        'delete_expired_batch': 'DELETE FROM messages WHERE id BETWEEN ? AND ? AND timestamp < ?',
+        'user_profile': 'SELECT {profile_columns} FROM user_profiles WHERE user_id = ?',
+        'recent_profiles': 'SELECT {profile_columns} FROM user_profiles WHERE last_seen >= ? '
+                           'ORDER BY last_seen DESC LIMIT ?',
+        'relationship_counts': 'SELECT relationship_level, COUNT(*) FROM user_profiles GROUP BY relationship_level',
+        # ORDER BY rank (= bm25) отдаётся самим FTS5 без сортировки; фильтр — как у MemoryFilter
+        'keyword_search': '''
+            SELECT m.id, messages_fts.rank FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH :query
+              AND (:chat_id IS NULL OR m.chat_id = :chat_id) AND (:user_id IS NULL OR m.user_id = :user_id)
+              AND (:thread_id IS NULL OR m.thread_id = :thread_id)
+              AND (:since IS NULL OR m.timestamp >= :since) AND (:until IS NULL OR m.timestamp < :until)
+            ORDER BY messages_fts.rank LIMIT :limit
+        ''',
+    }
+    # Запросы, которым проход по всему индексу нужен по смыслу (ORDER BY ... LIMIT, агрегат по таблице)
+    FULL_INDEX_SCANS = {'recent_messages', 'relationship_counts'}
+    
+    MESSAGE_INSERT = '''
+        INSERT INTO messages 
+        (user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
+         sentiment, importance, embedding, has_image, image_description, thread_id,
+         embedding_dim, embedding_model)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    PROFILE_UPSERT = '''
+        INSERT OR REPLACE INTO user_profiles 
+        (user_id, username, personality_traits, interests, interaction_count, last_seen, relationship_level,
+         interest_vector, interest_samples, interest_centroids, interest_labels)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    def message_row(self, message: Message, embedding: Optional[np.ndarray] = None) -> tuple:
+        """Параметры INSERT для сообщения"""
+        has_embedding = embedding is not None
+        return (
+            message.user_id, message.username, message.text, message.timestamp,
+            message.chat_id, message.message_id, message.is_reply, message.reply_to_user,
+            message.sentiment, message.importance,
+            self.encode_embedding(embedding) if has_embedding else None,
+            message.has_image, message.image_description, message.thread_id,
+            len(embedding) if has_embedding else None, self.embedding_model if has_embedding else None
+        )
+    
+    @staticmethod
+    def profile_row(profile: UserProfile) -> tuple:
+        """Параметры UPSERT для профиля (снимок: профиль дальше может меняться)"""
+        return (
+            profile.user_id, profile.username,
+            pickle.dumps(profile.personality_traits),
+            pickle.dumps(profile.interests),
+            profile.interaction_count, profile.last_seen, profile.relationship_level,
+            pickle.dumps(profile.interest_vector), profile.interest_samples,
+            pickle.dumps(profile.interest_centroids), pickle.dumps(profile.interest_labels)
+        )
+    
+    def write_batch(self, message_rows: List[tuple], profile_rows: List[tuple] = ()) -> List[int]:
+        """Сообщения и профили одной транзакцией через executemany, вернуть rowid сообщений
+        
+        Пишущее соединение одно и держит замок, так что AUTOINCREMENT выдаёт
+        пачке подряд идущие id — их восстанавливаем по last_insert_rowid().
+        """
+        with self.writer() as conn:
+            row_ids = []
+            if message_rows:
+                conn.executemany(self.MESSAGE_INSERT, message_rows)
+                last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+                row_ids = list(range(last_id - len(message_rows) + 1, last_id + 1))
+            if profile_rows:
+                conn.executemany(self.PROFILE_UPSERT, profile_rows)
+        return row_ids
+    
+    def save_message(self, message: Message, embedding: Optional[np.ndarray] = None) -> int:
+        """Сохранить сообщение в БД, вернуть его rowid"""
+        with self.writer() as conn:
+            return conn.execute(self.MESSAGE_INSERT, self.message_row(message, embedding)).lastrowid
+    
+    def save_messages(self, messages: List[Message], embeddings: List[np.ndarray]) -> List[int]:
+        """Сохранить пачку сообщений одной транзакцией, вернуть их rowid"""
+        return self.write_batch([self.message_row(m, e) for m, e in zip(messages, embeddings)])
     
     def get_user_history(self, user_id: int, limit: int = 20) -> List[Message]:
         """Получить историю пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.reader() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
-                       sentiment, importance, has_image, image_description
-                FROM messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
-            ''', (user_id, limit))
+            cursor.execute(self.QUERIES['user_history'], (user_id, limit))
             
             rows = cursor.fetchall()
             messages = []
@@ -466,71 +2101,645 @@ class DatabaseManager:
                 messages.append(msg)
             return messages
     
+    def encode_embedding(self, embedding: np.ndarray) -> bytes:
+        """Сырые little-endian байты в формате хранения: float32, float16 или int8 + масштаб"""
+        embedding = np.asarray(embedding, dtype='<f4')
+        if self.embedding_storage == 'float16':
+            return embedding.astype('<f2').tobytes()
+        if self.embedding_storage == 'int8':
+            quantized, scale = quantize_int8(embedding)
+            return quantized.tobytes() + np.asarray(scale, dtype='<f4').tobytes()
+        return embedding.tobytes()
+    
+    @staticmethod
+    def decode_embedding(blob: bytes, dim: Optional[int] = None) -> np.ndarray:
+        """Прочитать эмбеддинг как float32
+        
+        Формат сырого BLOB'а различается по длине: 4·dim байт — float32 (отдаётся
+        через np.frombuffer без копирования, только для чтения), 2·dim — float16,
+        dim + 4 — int8 и масштаб. Без dim это строка до миграции — pickle.
+        """
+        if dim is None:
+            payload = pickle.loads(blob)
+            if isinstance(payload, tuple):
+                quantized, scale = payload
+                return quantized.astype(np.float32) * np.float32(scale)
+            return np.asarray(payload, dtype=np.float32)
+        
+        if len(blob) == 4 * dim:
+            return np.frombuffer(blob, dtype='<f4')
+        if len(blob) == 2 * dim:
+            return np.frombuffer(blob, dtype='<f2').astype(np.float32)
+        if len(blob) == dim + 4:
+            scale = np.frombuffer(blob, dtype='<f4', count=1, offset=dim)[0]
+            return np.frombuffer(blob, dtype=np.int8, count=dim).astype(np.float32) * scale
+        raise ValueError(f"BLOB эмбеддинга в {len(blob)} байт не подходит к размерности {dim}")
+    
+    def migrate_embeddings_batch(self, after_id: int = 0, batch_size: int = 1000) -> Tuple[int, int]:
+        """Переписать пачку pickle-эмбеддингов с id > after_id в сырой формат
+        
+        Вернуть (последний просмотренный id, сколько строк переписано); тот же
+        after_id — старых строк не осталось. Каждая пачка — своя короткая транзакция, так что
+        миграция идёт параллельно с работающим ботом.
+        """
+        with self.reader() as conn:
+            rows = conn.execute(self.QUERIES['legacy_embeddings'], (after_id, batch_size)).fetchall()
+        if not rows:
+            return after_id, 0
+        
+        updates = []
+        for row_id, blob in rows:
+            try:
+                embedding = self.decode_embedding(blob)
+            except Exception as e:
+                logger.error(f"❌ Не удалось прочитать эмбеддинг сообщения {row_id}: {e}")
+                continue
+            updates.append((self.encode_embedding(embedding), len(embedding), self.embedding_model, row_id))
+        
+        with self.writer() as conn:
+            # embedding_dim IS NULL: строку могли переписать, пока мы её конвертировали
+            conn.executemany(self.QUERIES['migrate_embedding'], updates)
+        return rows[-1][0], len(updates)
+    
+    def get_message_id_range(self) -> Tuple[int, int]:
+        """Минимальный и максимальный rowid в таблице messages (0, 0 для пустой)"""
+        with self.reader() as conn:
+            row = conn.execute(self.QUERIES['message_id_range']).fetchone()
+            return row[0] or 0, row[1] or 0
+    
+    def iter_embeddings(self, max_id: int, batch_size: int = 5000, min_id: int = 0):
+        """Постранично выдать (rowids, матрица эмбеддингов, метаданные) сообщений с min_id < id <= max_id"""
+        last_id = min_id
+        with self.reader() as conn:
+            while True:
+                rows = conn.execute(
+                    self.QUERIES['embeddings_page'], (last_id, max_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                yield self._embedding_batch(rows)
+    
+    def _embedding_batch(self, rows: List[tuple]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Строки embeddings_page / embeddings_by_ids → (rowids, матрица эмбеддингов, метаданные)"""
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        vectors = np.stack([self.decode_embedding(row[1], row[7]) for row in rows])
+        meta = np.array([(row[2], row[3], -1 if row[4] is None else row[4], row[5],
+                          0.5 if row[6] is None else row[6])
+                         for row in rows], dtype=META_DTYPE)
+        return ids, vectors, meta
+    
+    def get_embedded_ids(self, max_id: int, min_id: int = 0) -> np.ndarray:
+        """Rowid сообщений с эмбеддингом в (min_id, max_id], по возрастанию"""
+        with self.reader() as conn:
+            rows = conn.execute(self.QUERIES['embedded_ids'], (min_id, max_id)).fetchall()
+        return np.array([row[0] for row in rows], dtype=np.int64)
+    
+    def iter_embeddings_by_ids(self, ids: np.ndarray, batch_size: int = 500):
+        """Как iter_embeddings, но для заданного набора rowid (пачками под лимит параметров SQLite)"""
+        with self.reader() as conn:
+            for start in range(0, len(ids), batch_size):
+                batch = [int(i) for i in ids[start:start + batch_size]]
+                sql = self.QUERIES['embeddings_by_ids'].format(placeholders=",".join("?" * len(batch)))
+                rows = conn.execute(sql, batch).fetchall()
+                if rows:
+                    yield self._embedding_batch(rows)
+    
+    def get_messages_by_ids(self, ids: List[int]) -> Dict[int, Message]:
+        """Загрузить сообщения по rowid"""
+        if not ids:
+            return {}
+        
+        placeholders = ",".join("?" * len(ids))
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self.QUERIES['messages_by_ids'].format(placeholders=placeholders), [int(i) for i in ids])
+            
+            messages = {}
+            for row in cursor.fetchall():
+                msg = Message(*row[1:11])
+                msg.has_image = row[11] or False
+                msg.image_description = row[12]
+                msg.thread_id = row[13]
+                messages[row[0]] = msg
+            return messages
+    
     def save_user_profile(self, profile: UserProfile):
         """Сохранить профиль пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_profiles 
-                (user_id, username, personality_traits, interests, interaction_count, last_seen, relationship_level)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                profile.user_id, profile.username,
-                pickle.dumps(profile.personality_traits),
-                pickle.dumps(profile.interests),
-                profile.interaction_count, profile.last_seen, profile.relationship_level
-            ))
-            conn.commit()
+        with self.writer() as conn:
+            conn.execute(self.PROFILE_UPSERT, self.profile_row(profile))
+    
+    PROFILE_COLUMNS = '''
+        user_id, username, personality_traits, interests, interaction_count, last_seen,
+        relationship_level, interest_vector, interest_samples, interest_centroids, interest_labels
+    '''
+    
+    @staticmethod
+    def profile_from_row(row: tuple) -> UserProfile:
+        return UserProfile(
+            user_id=row[0],
+            username=row[1],
+            personality_traits=pickle.loads(row[2]),
+            interests=pickle.loads(row[3]),
+            interaction_count=row[4],
+            last_seen=row[5],
+            relationship_level=row[6],
+            interest_vector=pickle.loads(row[7]) if row[7] else None,
+            interest_samples=row[8] or 0,
+            # Старые профили хранили общие для всех чатов кластеры с текстами сообщений — не берём
+            interest_centroids=DatabaseManager._per_chat(row[9]),
+            interest_labels=DatabaseManager._per_chat(row[10])
+        )
+    
+    @staticmethod
+    def _per_chat(blob: Optional[bytes]) -> dict:
+        value = pickle.loads(blob) if blob else None
+        return value if isinstance(value, dict) else {}
     
     def get_user_profile(self, user_id: int) -> Optional[UserProfile]:
         """Получить профиль пользователя"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM user_profiles WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                return UserProfile(
-                    user_id=row[0],
-                    username=row[1],
-                    personality_traits=pickle.loads(row[2]),
-                    interests=pickle.loads(row[3]),
-                    interaction_count=row[4],
-                    last_seen=row[5],
-                    relationship_level=row[6]
-                )
-            return None
+        with self.reader() as conn:
+            row = conn.execute(
+                self.QUERIES['user_profile'].format(profile_columns=self.PROFILE_COLUMNS), (user_id,)
+            ).fetchone()
+        return self.profile_from_row(row) if row else None
+    
+    def get_recent_profiles(self, since: float, limit: int) -> List[UserProfile]:
+        """Профили пользователей, активных после since (самые свежие первыми)"""
+        with self.reader() as conn:
+            rows = conn.execute(
+                self.QUERIES['recent_profiles'].format(profile_columns=self.PROFILE_COLUMNS), (since, limit)
+            ).fetchall()
+        return [self.profile_from_row(row) for row in rows]
+    
+    @staticmethod
+    def fts_query(text: str, max_terms: int = 8) -> str:
+        """Запрос FTS5 из текста сообщения: слова через OR, с префиксным поиском
+        
+        Стеммера для русского в FTS5 нет, поэтому у длинных кириллических слов
+        отрезается окончание (два последних символа) и ищется префикс: «сервера»
+        найдёт и «сервер», и «серверу». Короткие слова (<3 символов) и STOPWORDS
+        («что», «это», «как») пропускаются: префиксом они совпадают почти с каждой
+        строкой. Из длинного сообщения берутся max_terms самых длинных слов.
+        """
+        terms = []
+        for word in re.findall(r'\w+', text.lower()):
+            if len(word) < 3 or word in STOPWORDS:
+                continue
+            if len(word) >= 6 and re.fullmatch(r'[а-яё]+', word):
+                word = word[:-2]
+            if word not in terms:
+                terms.append(word)
+        if len(terms) > max_terms:
+            terms = sorted(terms, key=len, reverse=True)[:max_terms]
+        return " OR ".join(f'"{term}"*' for term in terms)
+    
+    def search_text(self, text: str, limit: int = 5,
+                    memory_filter: Optional[MemoryFilter] = None) -> List[Message]:
+        """Поиск по ключевым словам (BM25) по всей истории на диске, лучшие первыми"""
+        query = self.fts_query(text)
+        if not self.has_fts or not query:
+            return []
+        memory_filter = memory_filter or MemoryFilter()
+        with self.reader() as conn:
+            ids = [row[0] for row in conn.execute(self.QUERIES['keyword_search'], {
+                'query': query, 'limit': limit, 'chat_id': memory_filter.chat_id,
+                'user_id': memory_filter.user_id, 'thread_id': memory_filter.thread_id,
+                'since': memory_filter.since, 'until': memory_filter.until,
+            })]
+        messages = self.get_messages_by_ids(ids)
+        return [messages[row_id] for row_id in ids if row_id in messages]
+    
+    def count_relationships(self) -> Dict[str, int]:
+        """Число сохранённых профилей по уровню отношений"""
+        with self.reader() as conn:
+            return dict(conn.execute(self.QUERIES['relationship_counts']).fetchall())
+    
+    def get_user_embeddings(self, user_id: int, limit: int = 2000) -> Dict[int, Tuple[List[str], np.ndarray]]:
+        """Тексты и эмбеддинги последних сообщений пользователя по чатам"""
+        with self.reader() as conn:
+            rows = conn.execute(self.QUERIES['user_embeddings'], (user_id, limit)).fetchall()
+        by_chat: Dict[int, List[tuple]] = defaultdict(list)
+        for row in rows:
+            by_chat[row[3]].append(row)
+        return {
+            chat_id: ([row[0] for row in chat_rows],
+                      np.stack([self.decode_embedding(row[1], row[2]) for row in chat_rows]))
+            for chat_id, chat_rows in by_chat.items()
+        }
     
-    def cleanup_old_messages(self, days: int = 30):
-        """Очистка старых сообщений"""
+    ARCHIVE_COLUMNS = ('id', 'user_id', 'username', 'text', 'timestamp', 'chat_id', 'message_id', 'is_reply',
+                       'reply_to_user', 'sentiment', 'importance', 'has_image', 'image_description', 'thread_id')
+    
+    def cleanup_old_messages(self, days: int = 30, batch_size: int = 5000, pause: float = 0.05,
+                             archive_dir: str = '') -> int:
+        """Удалить сообщения старше days пачками по диапазонам rowid, вернуть их число
+        
+        Каждая пачка — короткая транзакция, между пачками пауза, так что писатель
+        бота не ждёт замка базы. С archive_dir строки (без эмбеддингов) сначала
+        дописываются в `messages-ГГГГ-ММ-ДД.jsonl.gz` по дню сообщения. Вызывать
+        из пула потоков, не из event loop'а.
+        """
         cutoff_time = time.time() - (days * 24 * 3600)
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM messages WHERE timestamp < ?', (cutoff_time,))
-            deleted = cursor.rowcount
-            conn.commit()
-            logger.info(f"🗑️ Удалено {deleted} старых сообщений")
+        with self.reader() as conn:
+            low, high = conn.execute(self.QUERIES['expired_id_range'], (cutoff_time,)).fetchone()
+        if low is None:
+            return 0
+        
+        deleted = 0
+        columns = ', '.join(self.ARCHIVE_COLUMNS)
+        for start in range(low, high + 1, batch_size):
+            end = min(start + batch_size - 1, high)
+            if archive_dir:
+                with self.reader() as conn:
+                    rows = conn.execute(
+                        self.QUERIES['expired_batch'].format(columns=columns), (start, end, cutoff_time)
+                    ).fetchall()
+                self.archive_rows(archive_dir, rows)
+            with self.writer() as conn:
+                deleted += conn.execute(
+                    self.QUERIES['delete_expired_batch'], (start, end, cutoff_time)
+                ).rowcount
+            time.sleep(pause)
+        
+        reclaimed = self.incremental_vacuum(pause=pause)
+        logger.info(f"🗑️ Удалено {deleted} старых сообщений"
+                    + (f", в архив: {archive_dir}" if archive_dir else "")
+                    + (f", освобождено {reclaimed} страниц" if reclaimed else ""))
+        return deleted
+    
+    def archive_rows(self, archive_dir: str, rows: List[tuple]):
+        """Дописать строки messages в gzip-JSONL, по файлу на день сообщения"""
+        by_day = defaultdict(list)
+        for row in rows:
+            record = dict(zip(self.ARCHIVE_COLUMNS, row))
+            by_day[datetime.fromtimestamp(record['timestamp']).strftime('%Y-%m-%d')].append(record)
+        
+        os.makedirs(archive_dir, exist_ok=True)
+        for day, records in by_day.items():
+            # Режим 'at' добавляет новый gzip-member; gzip читает такие файлы целиком
+            with gzip.open(os.path.join(archive_dir, f"messages-{day}.jsonl.gz"), 'at', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    
+    def query_plans(self) -> Dict[str, List[str]]:
+        """EXPLAIN QUERY PLAN каждого запроса из QUERIES: имя -> строки плана"""
+        plans = {}
+        with self.reader() as conn:
+            for name, query in self.QUERIES.items():
+                if 'messages_fts' in query and not self.has_fts:
+                    continue
+                sql = query.format(placeholders='?, ?', columns='id, text',
+                                   profile_columns=self.PROFILE_COLUMNS)
+                named = re.findall(r':(\w+)', sql)
+                params = dict.fromkeys(named) if named else [None] * sql.count('?')
+                plans[name] = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+        return plans
+    
+    def check_query_plans(self) -> List[str]:
+        """Прогнать EXPLAIN QUERY PLAN по всем QUERIES и вернуть найденные проблемы
+        
+        Проблема — любой SCAN (кроме прохода по индексу у FULL_INDEX_SCANS) или
+        временное B-дерево для ORDER BY / GROUP BY. Пустой список значит, что все
+        запросы ищут по индексам.
+        """
+        problems = []
+        for name, plan in self.query_plans().items():
+            for detail in plan:
+                allowed = ((name in self.FULL_INDEX_SCANS and ' USING ' in detail)
+                           or detail == 'SCAN CONSTANT ROW' or 'VIRTUAL TABLE INDEX' in detail)
+                if (detail.startswith('SCAN ') and not allowed) or 'TEMP B-TREE' in detail:
+                    problems.append(f"{name}: {detail}")
+        return problems
+    
+    def incremental_vacuum(self, pages_per_step: int = 1024, pause: float = 0.05) -> int:
+        """Вернуть свободные страницы файловой системе порциями, вернуть их число
+        
+        Работает при auto_vacuum=INCREMENTAL; старую базу нужно один раз
+        перевести полным VACUUM (`python tools.py vacuum`).
+        """
+        with self.reader() as conn:
+            mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if mode != 2:
+            if free:
+                logger.info(f"💡 В базе {free} свободных страниц, но auto_vacuum не INCREMENTAL: "
+                            f"один раз выполните python tools.py vacuum")
+            return 0
+        
+        reclaimed = 0
+        while free > 0:
+            with self.writer() as conn:
+                conn.execute(f'PRAGMA incremental_vacuum({pages_per_step})').fetchall()
+                left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if left >= free:
+                break
+            reclaimed += free - left
+            free = left
+            time.sleep(pause)
+        return reclaimed
+
+class ProfileCache:
+    """Ограниченный LRU-кэш профилей поверх таблицы user_profiles
+
+    Промах читает профиль из БД, так что отношения переживают перезапуск, а в
+    памяти держится не больше `capacity` профилей. Изменённые профили помечаются
+    грязными; вытесненный грязный профиль ждёт записи в `evicted` (и оттуда же
+    отдаётся при повторном обращении), пока запись не закоммичена (`commit_dirty`):
+    до коммита в БД лежит старая строка, и читать её нельзя.
+    Пользователи, которых нет в БД, тоже кэшируются (`missing`), чтобы каждое
+    сообщение новичка не ходило в SQLite. На event loop промах читается через
+    `fetch` в пуле потоков. Доступ из фоновых потоков защищён замком.
+    """
+    def __init__(self, db: DatabaseManager, capacity: int = 10000):
+        self.db = db
+        self.capacity = max(capacity, 1)
+        self.profiles: OrderedDict = OrderedDict()
+        self.evicted: Dict[int, UserProfile] = {}
+        self.missing: OrderedDict = OrderedDict()
+        self.dirty: set = set()
+        self.writing: Counter = Counter()  # забраны take_dirty, но ещё не закоммичены
+        self.commits = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self) -> int:
+        return len(self.profiles)
+    
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.profiles or user_id in self.evicted
+    
+    def values(self) -> List[UserProfile]:
+        """Снимок закэшированных профилей"""
+        with self.lock:
+            return list(self.profiles.values())
+    
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+    
+    def _insert(self, profile: UserProfile):
+        """Положить профиль в голову LRU и вытеснить лишние (вызывается под замком)"""
+        self.missing.pop(profile.user_id, None)
+        self.profiles[profile.user_id] = profile
+        self.profiles.move_to_end(profile.user_id)
+        while len(self.profiles) > self.capacity:
+            user_id, old = self.profiles.popitem(last=False)
+            if user_id in self.dirty or user_id in self.writing:
+                self.evicted[user_id] = old
+    
+    def _lookup(self, user_id: int) -> Tuple[bool, Optional[UserProfile], int]:
+        """(ответ известен без БД, профиль, номер коммита на момент промаха)"""
+        with self.lock:
+            profile = self.profiles.get(user_id)
+            if profile is None:
+                profile = self.evicted.pop(user_id, None)
+                if profile is not None:
+                    self._insert(profile)
+            else:
+                self.profiles.move_to_end(user_id)
+            if profile is not None or user_id in self.missing:
+                self.hits += 1
+                return True, profile, self.commits
+            self.misses += 1
+            return False, None, self.commits
+    
+    def _store(self, user_id: int, profile: Optional[UserProfile],
+               commits: int) -> Tuple[bool, Optional[UserProfile], int]:
+        """Положить прочитанное из БД; False — пока читали, закоммитили запись, читать заново"""
+        with self.lock:
+            # Пока читали БД, профиль мог появиться в кэше — отдаём его
+            cached = self.profiles.get(user_id) or self.evicted.get(user_id)
+            if cached is not None:
+                return True, cached, self.commits
+            if self.commits != commits:
+                return False, None, self.commits
+            if profile is None:
+                self.missing[user_id] = True
+                self.missing.move_to_end(user_id)
+                while len(self.missing) > self.capacity:
+                    self.missing.popitem(last=False)
+            else:
+                self._insert(profile)
+            return True, profile, commits
+    
+    def get(self, user_id: int) -> Optional[UserProfile]:
+        """Профиль из кэша или из БД; None, если пользователя ещё нет"""
+        found, profile, commits = self._lookup(user_id)
+        while not found:
+            found, profile, commits = self._store(user_id, self.db.get_user_profile(user_id), commits)
+        return profile
+    
+    async def fetch(self, user_id: int) -> Optional[UserProfile]:
+        """То же, что get, но промах читает БД в пуле потоков, не блокируя event loop"""
+        found, profile, commits = self._lookup(user_id)
+        loop = asyncio.get_running_loop()
+        while not found:
+            row = await loop.run_in_executor(None, self.db.get_user_profile, user_id)
+            found, profile, commits = self._store(user_id, row, commits)
+        return profile
+    
+    def __getitem__(self, user_id: int) -> UserProfile:
+        profile = self.get(user_id)
+        if profile is None:
+            raise KeyError(user_id)
+        return profile
+    
+    def __setitem__(self, user_id: int, profile: UserProfile):
+        with self.lock:
+            self.evicted.pop(user_id, None)
+            self._insert(profile)
+    
+    def preload(self, profiles: List[UserProfile]):
+        """Загрузить профили при старте (не вытесняя уже загруженные)"""
+        with self.lock:
+            for profile in profiles[:self.capacity - len(self.profiles)]:
+                self.profiles.setdefault(profile.user_id, profile)
+    
+    def mark_dirty(self, profile: UserProfile):
+        """Отметить профиль к записи; уже вытесненный объект тоже не потеряется"""
+        with self.lock:
+            self.dirty.add(profile.user_id)
+            self.missing.pop(profile.user_id, None)
+            if profile.user_id not in self.profiles:
+                self.evicted[profile.user_id] = profile
+    
+    def take_dirty(self) -> List[UserProfile]:
+        """Забрать изменённые профили (вместе с вытесненными) и очистить отметки
+        
+        Вытесненные остаются в `evicted` до commit_dirty или restore_dirty.
+        """
+        with self.lock:
+            profiles = [self.profiles.get(user_id) or self.evicted[user_id]
+                        for user_id in self.dirty if user_id in self]
+            self.writing.update(profile.user_id for profile in profiles)
+            self.dirty.clear()
+        return profiles
+    
+    def _finish(self, profiles: List[UserProfile]):
+        for profile in profiles:
+            self.writing[profile.user_id] -= 1
+            if self.writing[profile.user_id] <= 0:
+                del self.writing[profile.user_id]
+    
+    def commit_dirty(self, profiles: List[UserProfile]):
+        """Запись профилей закоммичена: вытесненные больше не нужно держать в памяти"""
+        with self.lock:
+            self._finish(profiles)
+            self.commits += 1
+            for profile in profiles:
+                user_id = profile.user_id
+                if user_id not in self.dirty and user_id not in self.writing:
+                    self.evicted.pop(user_id, None)
+    
+    def restore_dirty(self, profiles: List[UserProfile]):
+        """Вернуть профили в грязные, если запись не удалась"""
+        with self.lock:
+            self._finish(profiles)
+            for profile in profiles:
+                self.dirty.add(profile.user_id)
+                if profile.user_id not in self.profiles:
+                    self.evicted[profile.user_id] = profile
+
+@dataclass
+class RetrievalPlan:
+    """Что собирать в контекст для данной причины ответа"""
+    recent: int = 5  # сколько недавних сообщений показать
+    profile: bool = True  # блок профиля в контексте и в промпте
+    memories: int = 3  # сколько воспоминаний искать; 0 — без векторного поиска
+    interests: bool = True  # воспоминания, близкие к интересам собеседника
+
+# Дешёвым причинам память не нужна: ни поиска, ни эмбеддинга запроса, ни профиля
+RETRIEVAL_PLANS: Dict[str, RetrievalPlan] = {
+    "greeting": RetrievalPlan(recent=3, profile=False, memories=0, interests=False),
+    "random_response": RetrievalPlan(recent=5, profile=False, memories=0, interests=False),
+    "active_user": RetrievalPlan(recent=5, profile=True, memories=0, interests=False),
+    "long_post": RetrievalPlan(recent=3, profile=False, memories=2, interests=False),
+}
+DEFAULT_RETRIEVAL_PLAN = RetrievalPlan()
 
 class AdvancedContextManager:
     """Продвинутый менеджер контекста с поддержкой изображений"""
-    def __init__(self, config: BotConfig):
+    def __init__(self, config: BotConfig, encoder: Any = None):
         self.config = config
-        self.db = DatabaseManager(config.memory_db_path)
-        self.vector_memory = VectorMemory(config.embedding_model)
+        self.db = DatabaseManager(config.memory_db_path, config.embedding_storage,
+                                  config.db_cache_size_mb, config.db_mmap_size_mb, config.embedding_model)
+        if encoder is None:
+            encoder = create_encoder(
+                config.embedding_model, config.embedding_backend, config.embedding_onnx_dir,
+                config.embedding_max_seq_length
+            )
+        self.embedding_service = EmbeddingService(
+            encoder, config.embedding_batch_wait_ms, config.embedding_max_batch,
+            config.embedding_cache_size, config.embedding_max_pending
+        )
+        self.vector_memory = VectorMemory(
+            config.embedding_model, config.vector_memory_capacity,
+            encoder=encoder, embedding_service=self.embedding_service,
+            storage=config.embedding_storage, binary_prefilter=config.binary_prefilter,
+            rerank_factor=config.prefilter_rerank_factor
+        )
+        self.retrieval_weights = RetrievalWeights(
+            config.retrieval_similarity_weight, config.retrieval_importance_weight,
+            config.retrieval_recency_weight, config.retrieval_half_life_hours
+        )
+        self.retrieval_times_ms: Dict[str, Histogram] = defaultdict(
+            lambda: Histogram([1, 2, 5, 10, 20, 50, 100, 250])
+        )
+        self.prompt_sizes: Dict[str, Histogram] = defaultdict(
+            lambda: Histogram([500, 1000, 1500, 2000, 3000, 4000])
+        )
+        self.enrichment_queue: Optional[asyncio.Queue] = None
+        self.enrichment_worker: Optional[asyncio.Task] = None
+        self.write_queue: Optional[asyncio.Queue] = None
+        self.write_worker: Optional[asyncio.Task] = None
+        self.overflow_writes: set = set()  # ожидающие места в очереди записи с пути ответа
+        self.write_batch_sizes = Histogram([1, 4, 16, 64, 256, 1024])
+        self.profile_writes = 0
         self.recent_messages: deque = deque(maxlen=config.context_window)
-        self.user_profiles: Dict[int, UserProfile] = {}
+        self.user_profiles = ProfileCache(self.db, config.profile_cache_size)
+        if config.profile_preload_days > 0:
+            since = time.time() - config.profile_preload_days * 86400
+            self.user_profiles.preload(self.db.get_recent_profiles(since, config.profile_cache_size))
+            logger.info(f"👤 Предзагружено {len(self.user_profiles)} профилей")
         self.load_recent_messages()
+        
+        self.vector_log: Optional[VectorLog] = None
+        if config.vector_log_dir:
+            self.vector_log = VectorLog(
+                config.vector_log_dir, self.vector_memory.dim, config.vector_log_period_days
+            )
+        
+        self.long_term_index: Optional[IVFIndex] = None
+        if config.enable_long_term_memory:
+            self.long_term_index = IVFIndex(
+                self.vector_memory.dim, config.ivf_nprobe, config.ivf_nlist,
+                storage=config.embedding_storage, binary_prefilter=config.binary_prefilter,
+                rerank_factor=config.prefilter_rerank_factor
+            )
+        
+        if self.long_term_index is not None or self.vector_log is not None:
+            # Граница фиксируется до старта бота: всё, что новее, пишется на лету
+            _, max_id = self.db.get_message_id_range()
+            threading.Thread(
+                target=self._build_long_term_index, args=(max_id,), name="ivf-bootstrap", daemon=True
+            ).start()
+    
+    def _build_long_term_index(self, max_id: int):
+        """Фоновая загрузка эмбеддингов в IVF-индекс
+        
+        С журналом векторов сначала дописываем в него то, чего там ещё нет
+        (например, историю до включения журнала), а индекс строим уже из
+        memmap-сегментов — без распаковки BLOB'ов из БД. Недостающее ищется
+        сверкой множеств rowid, а не от наибольшего записанного: живые дозаписи
+        идут вперемешку с догрузкой, и после прерванного старта в журнале
+        бывают дыры ниже его максимума.
+        """
+        try:
+            started = time.time()
+            if self.vector_log is not None:
+                missing = np.setdiff1d(self.db.get_embedded_ids(max_id), self.vector_log.ids(),
+                                       assume_unique=True)
+                if len(missing):
+                    logger.info(f"📼 Дописываю в журнал векторов {len(missing)} строк из БД")
+                for ids, vectors, meta in self.db.iter_embeddings_by_ids(missing):
+                    self.vector_log.append(ids, vectors, meta)
+                if self.long_term_index is not None:
+                    for ids, vectors, meta in self.vector_log.iter_segments():
+                        # Более новые строки индексируются на лету в _flush_writes
+                        known = ids <= max_id
+                        self.long_term_index.add(ids[known], vectors[known], meta[known])
+                        self.long_term_index.wait_for_retrain()
+                logger.info(f"📼 Журнал векторов: {len(self.vector_log)} векторов")
+            elif self.long_term_index is not None:
+                for ids, vectors, meta in self.db.iter_embeddings(max_id):
+                    self.long_term_index.add(ids, vectors, meta)
+                    self.long_term_index.wait_for_retrain()
+            if self.long_term_index is not None:
+                logger.info(f"🗂️ Долговременная память: {len(self.long_term_index)} векторов "
+                            f"за {time.time() - started:.1f}с")
+        except Exception as e:
+            logger.error(f"❌ Ошибка построения индекса долговременной памяти: {e}")
+    
+    def prune_long_term_index(self):
+        """Убрать из индекса векторы сообщений, удалённых очисткой БД, и старые сегменты журнала"""
+        if self.long_term_index is not None:
+            min_id, _ = self.db.get_message_id_range()
+            self.long_term_index.drop_ids_below(min_id)
+        if self.vector_log is not None:
+            cutoff = time.time() - Constants.DEFAULT_CLEANUP_DAYS * 24 * 3600
+            dropped = self.vector_log.drop_before(cutoff)
+            if dropped:
+                logger.info(f"📼 Удалено {dropped} старых сегментов журнала векторов")
     
     def load_recent_messages(self):
         """Загрузить недавние сообщения из БД при старте"""
         try:
-            with sqlite3.connect(self.config.memory_db_path) as conn:
+            with self.db.reader() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT user_id, username, text, timestamp, chat_id, message_id, is_reply, reply_to_user, 
-                           sentiment, importance, has_image, image_description
-                    FROM messages ORDER BY timestamp DESC LIMIT ?
-                ''', (self.config.context_window,))
+                cursor.execute(self.db.QUERIES['recent_messages'], (self.config.context_window,))
                 
                 rows = cursor.fetchall()
                 loaded_count = 0
@@ -540,9 +2749,15 @@ class AdvancedContextManager:
                         if len(row) > 10:
                             msg.has_image = row[10] or False
                             msg.image_description = row[11]
+                        msg.thread_id = row[13]
                         
                         self.recent_messages.append(msg)
-                        self.vector_memory.add_message(msg)
+                        # Эмбеддинг уже лежит в БД — модель при старте не гоняем
+                        if row[12] is not None:
+                            msg.embedding = self.db.decode_embedding(row[12], row[14])
+                            self.vector_memory.add_embedding(msg, msg.embedding)
+                        else:
+                            self.vector_memory.add_message(msg)
                         loaded_count += 1
                     except Exception as e:
                         logger.error(f"Ошибка загрузки сообщения: {e}")
@@ -554,29 +2769,231 @@ class AdvancedContextManager:
     
 
     
-    def add_message(self, message: Message):
+    async def add_message(self, message: Message):
         """Добавить сообщение во все системы памяти"""
+        self.observe_message(message)
+        await self.enrich_message(message)
+    
+    def observe_message(self, message: Message):
+        """Дешёвая часть: сообщение сразу видно в недавнем контексте (без модели и БД)"""
+        self.recent_messages.append(message)
+    
+    async def enrich_message(self, message: Message):
+        """Важность, тональность, профиль, эмбеддинг и постановка в очередь записи
+        
+        Это путь ответа: эмбеддинг считается вне очереди фоновых запросов, а запись
+        в БД ставится без ожидания места в очереди записи.
+        """
         message.importance = self._calculate_importance(message)
         message.sentiment = self._analyze_sentiment(message.text)
+        await self.user_profiles.fetch(message.user_id)
+        self._update_user_profile(message)
         
-        self.recent_messages.append(message)
-        self.vector_memory.add_message(message)
+        try:
+            embedding = await self.embed_message(message, urgent=True)
+        except Exception as e:
+            logger.error(f"❌ Ошибка эмбеддинга сообщения: {e}")
+            return
+        self._index_embedding(message, embedding)
+        self.queue_write_nowait(message, embedding)
+    
+    async def defer_message(self, message: Message):
+        """Отложить обогащение сообщения, на которое бот не отвечает, в фоновую очередь"""
+        if self.enrichment_worker is None or self.enrichment_worker.done():
+            self.enrichment_queue = asyncio.Queue(maxsize=self.config.enrichment_batch_size * 16)
+            self.enrichment_worker = asyncio.create_task(self._run_enrichment())
+        await self.enrichment_queue.put(message)
+    
+    async def _run_enrichment(self):
+        while True:
+            batch = await collect_batch(
+                self.enrichment_queue, self.config.enrichment_batch_size,
+                self.config.enrichment_max_wait_ms / 1000
+            )
+            try:
+                await self._enrich_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка фонового обогащения {len(batch)} сообщений: {e}")
+            finally:
+                for _ in batch:
+                    self.enrichment_queue.task_done()
+    
+    async def _enrich_batch(self, batch: List[Message]):
+        """Пачка: эмбеддинги одним микро-батчем, запись в БД одной транзакцией"""
+        # Профили авторов подтягиваем из БД заранее и не на event loop
+        await asyncio.gather(*[self.user_profiles.fetch(user_id) for user_id in {m.user_id for m in batch}])
+        for message in batch:
+            message.importance = self._calculate_importance(message)
+            message.sentiment = self._analyze_sentiment(message.text)
+            self._update_user_profile(message)
         
-        asyncio.create_task(self._save_message_async(message))
-        self._update_user_profile(message)
+        embeddings = await asyncio.gather(*[self.embed_message(message) for message in batch])
+        for message, embedding in zip(batch, embeddings):
+            self._index_embedding(message, embedding)
+            await self.queue_write(message, embedding)
+    
+    def _index_embedding(self, message: Message, embedding: np.ndarray):
+        """Эмбеддинг в кольцо памяти и в вектор интересов автора"""
+        self.vector_memory.add_embedding(message, embedding)
+        profile = self.user_profiles.get(message.user_id)
+        if profile is not None:
+            profile.observe_embedding(embedding)
+            self.mark_profile_dirty(profile)
+    
+    def mark_profile_dirty(self, profile: UserProfile):
+        """Профиль изменён в памяти — записать при следующем flush_profiles"""
+        self.user_profiles.mark_dirty(profile)
     
-    async def _save_message_async(self, message: Message):
-        """Асинхронное сохранение в БД"""
+    async def flush_profiles(self) -> int:
+        """Записать все изменённые профили одной транзакцией, вернуть их число
+        
+        Сколько бы сообщений ни написал пользователь между сбросами, его строка
+        в user_profiles переписывается один раз. Снимок профилей делается в потоке
+        event loop'а, запись — в пуле потоков.
+        """
+        profiles = self.user_profiles.take_dirty()
+        if not profiles:
+            return 0
+        rows = [self.db.profile_row(profile) for profile in profiles]
+        
+        loop = asyncio.get_running_loop()
         try:
-            text_for_embedding = message.text
-            if message.image_description and not message.image_description in message.text:
-                text_for_embedding += f" {message.image_description}"
-            
-            embedding = self.vector_memory.encoder.encode([text_for_embedding])[0]
-            self.db.save_message(message, embedding)
+            await loop.run_in_executor(None, self.db.write_batch, [], rows)
         except Exception as e:
-            logger.error(f"❌ Ошибка сохранения сообщения: {e}")
+            logger.error(f"❌ Ошибка записи {len(rows)} профилей: {e}")
+            self.user_profiles.restore_dirty(profiles)
+            return 0
+        self.user_profiles.commit_dirty(profiles)
+        self.profile_writes += len(rows)
+        return len(rows)
+    
+    def _ensure_write_worker(self):
+        if self.write_worker is None or self.write_worker.done():
+            self.write_queue = asyncio.Queue(maxsize=self.config.write_queue_size)
+            self.write_worker = asyncio.create_task(self._run_writes())
+    
+    async def queue_write(self, message: Message, embedding: np.ndarray):
+        """Поставить сообщение в очередь записи; при полной очереди — ждать (backpressure)"""
+        self._ensure_write_worker()
+        await self.write_queue.put((message, embedding))
+    
+    def queue_write_nowait(self, message: Message, embedding: np.ndarray):
+        """Поставить сообщение в очередь записи, не дожидаясь места (путь ответа)
+        
+        При полной очереди запись ждёт места в отдельной задаче, а ответ уходит сразу.
+        """
+        self._ensure_write_worker()
+        try:
+            self.write_queue.put_nowait((message, embedding))
+        except asyncio.QueueFull:
+            task = asyncio.create_task(self.write_queue.put((message, embedding)))
+            self.overflow_writes.add(task)
+            task.add_done_callback(self.overflow_writes.discard)
+    
+    async def _run_writes(self):
+        """Единственный писатель: пачка по размеру или по времени — одна транзакция"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await collect_batch(
+                self.write_queue, self.config.write_batch_size, self.config.write_flush_ms / 1000
+            )
+            try:
+                await loop.run_in_executor(None, self._flush_writes, batch)
+                self.write_batch_sizes.observe(len(batch))
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи пачки из {len(batch)} сообщений: {e}")
+            finally:
+                for _ in batch:
+                    self.write_queue.task_done()
+    
+    def _flush_writes(self, batch: List[Tuple[Message, np.ndarray]]):
+        row_ids = self.db.write_batch(
+            [self.db.message_row(message, embedding) for message, embedding in batch]
+        )
+        embeddings = [embedding for _, embedding in batch]
+        meta = np.array([message_meta(message) for message, _ in batch], dtype=META_DTYPE)
+        if self.vector_log is not None:
+            self.vector_log.append(row_ids, embeddings, meta)
+        if self.long_term_index is not None:
+            self.long_term_index.add(row_ids, embeddings, meta)
+    
+    async def flush_enrichment(self):
+        """Дообработать очередь обогащения и остановить её (при выключении)"""
+        if self.enrichment_worker is None:
+            return
+        if not self.enrichment_worker.done():
+            await self.enrichment_queue.join()
+        self.enrichment_worker.cancel()
+        try:
+            await self.enrichment_worker
+        except asyncio.CancelledError:
+            pass
+        self.enrichment_worker = None
+    
+    async def flush_writes(self):
+        """Записать всё из очереди записи и остановить писателя (при выключении)"""
+        if self.write_worker is None:
+            return
+        if self.overflow_writes:
+            await asyncio.gather(*self.overflow_writes, return_exceptions=True)
+        if not self.write_worker.done():
+            await self.write_queue.join()
+        self.write_worker.cancel()
+        try:
+            await self.write_worker
+        except asyncio.CancelledError:
+            pass
+        self.write_worker = None
+    
+    async def embed_message(self, message: Message, urgent: bool = False) -> np.ndarray:
+        """Эмбеддинг сообщения: считается один раз и сохраняется в самом сообщении"""
+        if message.embedding is None:
+            text_for_embedding = VectorMemory.text_for_embedding(message)
+            message.embedding = await self.embedding_service.embed(text_for_embedding, urgent)
+        return message.embedding
+    
+    async def search_memories(self, query_embedding: np.ndarray, limit: int = 3,
+                              memory_filter: Optional[MemoryFilter] = None) -> List[Message]:
+        """Воспоминания: свежее кольцо в RAM + IVF по всей истории, без дублей
+        
+        memory_filter ограничивает поиск чатом / топиком / автором / окном времени.
+        Порядок — по взвешенному score: близость, важность и свежесть.
+        """
+        hits = self.vector_memory.search_scored(
+            query_embedding, limit, memory_filter, self.retrieval_weights
+        )
+        
+        if (self.long_term_index is not None and len(self.long_term_index)) or self.vector_log is not None:
+            loop = asyncio.get_running_loop()
+            hits += await loop.run_in_executor(
+                None, self._search_long_term, query_embedding, limit, memory_filter
+            )
+        
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        seen = set()
+        result = []
+        for _, msg in hits:
+            key = (msg.chat_id, msg.message_id)
+            if key in seen:
+                continue
+            seen.add(key)
+            result.append(msg)
+            if len(result) >= limit:
+                break
+        return result
     
+    def _search_long_term(self, query_embedding: np.ndarray, limit: int,
+                          memory_filter: Optional[MemoryFilter] = None) -> List[Tuple[float, Message]]:
+        # IVF — быстрый приближённый поиск; без него — точный проход по журналу
+        source = self.long_term_index if self.long_term_index is not None else self.vector_log
+        ids, scores = source.search(
+            query_embedding, limit * 2, Constants.MEMORY_SIMILARITY_THRESHOLD, memory_filter,
+            self.retrieval_weights
+        )
+        # Сообщения могли быть удалены очисткой — такие просто пропускаем
+        messages = self.db.get_messages_by_ids(ids.tolist())
+        return [(float(score), messages[i]) for i, score in zip(ids.tolist(), scores) if i in messages]
+
     def _calculate_importance(self, message: Message) -> float:
         """Вычисление важности сообщения"""
         importance = 0.5
@@ -616,7 +3033,7 @@ class AdvancedContextManager:
             return "neutral"
     
     def _update_user_profile(self, message: Message):
-        """Обновление профиля пользователя"""
+        """Обновление профиля пользователя в памяти (в БД он попадёт через flush_profiles)"""
         profile = self.user_profiles.get(message.user_id)
         if not profile:
             profile = UserProfile(
@@ -653,13 +3070,27 @@ class AdvancedContextManager:
         elif profile.interaction_count > 5:
             profile.relationship_level = "знакомый"
         
-        self.db.save_user_profile(profile)
+        self.mark_profile_dirty(profile)
     
-    def get_smart_context(self, user_id: int, query: str, limit: int = 10) -> str:
-        """Получить умный контекст с учётом изображений"""
+    async def get_smart_context(self, user_id: int, query: str, limit: int = 10,
+                                query_embedding: Optional[np.ndarray] = None,
+                                memory_filter: Optional[MemoryFilter] = None,
+                                reason: Optional[str] = None) -> str:
+        """Получить умный контекст с учётом изображений
+        
+        memory_filter применяется и к недавним сообщениям, и к воспоминаниям —
+        так переписка из лички не попадает в контекст группы и наоборот.
+        Состав контекста задаёт план для reason (RETRIEVAL_PLANS): эмбеддинг
+        запроса считается, только если план требует поиска по памяти.
+        """
+        started = time.perf_counter()
+        plan = RETRIEVAL_PLANS.get(reason, DEFAULT_RETRIEVAL_PLAN)
         context_parts = []
         
-        recent = list(self.recent_messages)[-5:]
+        recent = list(self.recent_messages)
+        if memory_filter is not None:
+            recent = [msg for msg in recent if memory_filter.matches(msg)]
+        recent = recent[-plan.recent:] if plan.recent else []
         if recent:
             context_parts.append("🕐 Недавние сообщения:")
             for msg in recent:
@@ -669,15 +3100,34 @@ class AdvancedContextManager:
                     text += " 📷"
                 context_parts.append(f"[{msg.username}] ({age}м назад): {text}")
         
-        profile = self.user_profiles.get(user_id)
-        if profile:
+        profile = await self.user_profiles.fetch(user_id)
+        if profile and plan.profile:
             traits = ", ".join([f"{k}: {v:.1f}" for k, v in profile.personality_traits.items()])
-            interests_str = ", ".join(profile.interests[:3]) if profile.interests else "не определены"
+            # Кластеры — только этого чата: то, о чём человек пишет в личке, в группе не всплывает
+            chat_id = memory_filter.chat_id if memory_filter is not None else None
+            interests = [label for label in profile.interest_labels.get(chat_id, []) if label] or profile.interests
+            interests_str = ", ".join(interests[:3]) if interests else "не определены"
             context_parts.append(f"\n👤 {profile.username} ({profile.relationship_level}, {profile.interaction_count} сообщений)")
             context_parts.append(f"   Характер: {traits}")
             context_parts.append(f"   Интересы: {interests_str}")
         
-        similar = self.vector_memory.search_similar(query, 3)
+        similar = []
+        if plan.memories:
+            if query_embedding is None:
+                query_embedding = await self.embedding_service.embed(query, urgent=True)
+            if self.config.keyword_search and self.db.has_fts:
+                # Сленг, ники и идентификаторы эмбеддинг ловит плохо — добавляем BM25 и сливаем по RRF
+                candidates = plan.memories * 2
+                loop = asyncio.get_running_loop()
+                by_vector, by_keywords = await asyncio.gather(
+                    self.search_memories(query_embedding, candidates, memory_filter),
+                    loop.run_in_executor(None, self.db.search_text, query, candidates, memory_filter)
+                )
+                similar = reciprocal_rank_fusion(
+                    [by_vector, by_keywords], plan.memories, self.config.rrf_k
+                )
+            else:
+                similar = await self.search_memories(query_embedding, plan.memories, memory_filter)
         if similar:
             context_parts.append("\n🧠 Релевантные воспоминания:")
             for msg in similar:
@@ -687,8 +3137,63 @@ class AdvancedContextManager:
                     text += " 📷"
                 context_parts.append(f"[{msg.username}] ({days_ago}д назад): {text}")
         
+        # Вектор интересов уже посчитан — это ещё один проход по памяти без encode
+        if plan.interests and profile and profile.interest_vector is not None:
+            shown = {(msg.chat_id, msg.message_id) for msg in similar}
+            related = [msg for msg in await self.search_memories(profile.interest_vector, 3, memory_filter)
+                       if (msg.chat_id, msg.message_id) not in shown][:2]
+            if related:
+                context_parts.append(f"\n🎯 Близко к интересам {profile.username}:")
+                for msg in related:
+                    context_parts.append(f"[{msg.username}]: {msg.text[:60]}")
+        
+        self.retrieval_times_ms[reason or "default"].observe((time.perf_counter() - started) * 1000)
         return "\n".join(context_parts)
     
+    def record_prompt(self, reason: str, prompt: str):
+        """Учесть размер промпта для статистики по причинам ответа"""
+        self.prompt_sizes[reason].observe(len(prompt))
+    
+    def refresh_interest_clusters(self):
+        """Пересчитать кластеры интересов активных пользователей (mini-batch k-means)
+        
+        Выполняется в фоне: эмбеддинги берутся из БД, кластеры строятся отдельно
+        для каждого чата, где пользователь достаточно писал, и сортируются по
+        размеру. Подпись кластера — ключевые слова (interest_keywords), а не текст
+        сообщения.
+        """
+        started = time.time()
+        refreshed = 0
+        for profile in list(self.user_profiles.values()):
+            if profile.interaction_count < self.config.interest_min_messages:
+                continue
+            try:
+                centroids_by_chat, labels_by_chat = {}, {}
+                for chat_id, (texts, vectors) in self.db.get_user_embeddings(profile.user_id).items():
+                    if len(texts) < self.config.interest_min_messages:
+                        continue
+                    centroids, assignment = minibatch_kmeans(vectors, self.config.interest_clusters)
+                    sizes = np.bincount(assignment, minlength=len(centroids))
+                    order = [int(c) for c in np.argsort(-sizes) if sizes[c]]
+                    centroids_by_chat[chat_id] = centroids[order]
+                    labels_by_chat[chat_id] = [
+                        interest_keywords([texts[i] for i in np.flatnonzero(assignment == cluster)], texts)
+                        for cluster in order
+                    ]
+                if not centroids_by_chat:
+                    continue
+                
+                profile.interest_centroids = centroids_by_chat
+                profile.interest_labels = labels_by_chat
+                self.mark_profile_dirty(profile)
+                refreshed += 1
+            except Exception as e:
+                logger.error(f"❌ Ошибка кластеризации интересов {profile.user_id}: {e}")
+        
+        if refreshed:
+            logger.info(f"🎯 Кластеры интересов обновлены для {refreshed} пользователей "
+                        f"за {time.time() - started:.1f}с")
+    
     def get_context(self, limit: int = 5) -> str:
         """Получить обычный контекст"""
         if not self.recent_messages:
@@ -712,23 +3217,219 @@ class AdvancedContextManager:
         
         return "\n".join(context_lines) if context_lines else ""
 
+# === ФИЛЬТР ВХОДЯЩИХ ===
+class IngestionFilter:
+    """Дешёвый фильтр перед обработчиками: дубли и всплески коротких сообщений
+    
+    Для каждого чата и каждого пользователя хранится скользящее окно хэшей
+    нормализованного текста за `duplicate_window` секунд. Повтор из окна
+    отбрасывается до эмбеддинга, БД и анализатора. Короткие сообщения («+», «лол»)
+    схлопываются: в окне `collapse_window` секунд проходит только первое на чат.
+    Отброшенное только считается в `counters`. Сообщения, адресованные боту (личка,
+    обращение по имени), не фильтруются: повтор там — это переспрос, например после
+    «попробуй ещё раз», а короткое «да» / «нет» — ответ на вопрос бота.
+    """
+    def __init__(self, duplicate_window: float = 120.0, collapse_window: float = 10.0,
+                 short_length: int = 4):
+        self.duplicate_window = duplicate_window
+        self.collapse_window = collapse_window
+        self.short_length = short_length
+        self.chat_hashes: Dict[int, Tuple[deque, Counter]] = defaultdict(lambda: (deque(), Counter()))
+        self.user_hashes: Dict[int, Tuple[deque, Counter]] = defaultdict(lambda: (deque(), Counter()))
+        self.last_short: Dict[int, float] = {}
+        self.counters: Counter = Counter()
+    
+    def _seen(self, window: Tuple[deque, Counter], key: bytes, now: float) -> bool:
+        """Проверить ключ в скользящем окне и добавить его туда"""
+        entries, counts = window
+        while entries and now - entries[0][0] > self.duplicate_window:
+            _, old_key = entries.popleft()
+            counts[old_key] -= 1
+            if not counts[old_key]:
+                del counts[old_key]
+        seen = counts[key] > 0
+        entries.append((now, key))
+        counts[key] += 1
+        return seen
+    
+    def is_short(self, text: str) -> bool:
+        stripped = text.strip()
+        return len(stripped) <= self.short_length and len(stripped.split()) <= 1
+    
+    def accept(self, chat_id: int, user_id: int, text: str, now: Optional[float] = None,
+               direct: bool = False) -> bool:
+        """Пропустить ли сообщение в полную обработку (direct — адресовано боту)"""
+        now = time.time() if now is None else now
+        
+        if direct:
+            self.counters['accepted'] += 1
+            return True
+        
+        if self.is_short(text):
+            if now - self.last_short.get(chat_id, float('-inf')) < self.collapse_window:
+                self.counters['short_burst'] += 1
+                return False
+            self.last_short[chat_id] = now
+            self.counters['accepted'] += 1
+            return True
+        
+        key = EmbeddingService.cache_key(text)
+        duplicate_in_chat = self._seen(self.chat_hashes[chat_id], key, now)
+        repeated_by_user = self._seen(self.user_hashes[user_id], key, now)
+        if duplicate_in_chat:
+            self.counters['duplicate'] += 1
+            return False
+        if repeated_by_user:
+            self.counters['user_repeat'] += 1
+            return False
+        
+        self.counters['accepted'] += 1
+        return True
+    
+    @property
+    def shed(self) -> int:
+        return sum(count for reason, count in self.counters.items() if reason != 'accepted')
+    
+    def cleanup(self, now: Optional[float] = None):
+        """Забыть окна чатов и пользователей, которые давно молчат"""
+        now = time.time() if now is None else now
+        for windows in (self.chat_hashes, self.user_hashes):
+            for owner in [owner for owner, (entries, _) in windows.items()
+                          if not entries or now - entries[-1][0] > self.duplicate_window]:
+                del windows[owner]
+        for chat_id in [chat_id for chat_id, seen in self.last_short.items()
+                        if now - seen > self.collapse_window]:
+            del self.last_short[chat_id]
+
+# === РОУТЕР НАМЕРЕНИЙ ===
+INTENT_LABELS = ('direct_mention', 'tech_question', 'question', 'greeting', 'chatter')
+# Намерение → причина ответа (chatter сам по себе ответа не требует)
+INTENT_REASONS = {
+    'direct_mention': 'direct_mention',
+    'tech_question': 'tech_question',
+    'question': 'question_to_chat',
+    'greeting': 'greeting',
+}
+
+class IntentRouter:
+    """Классификатор намерения по ближайшему центроиду поверх эмбеддинга сообщения
+    
+    Эмбеддинг уже посчитан для памяти, так что классификация — одно матричное
+    умножение (labels × dim) без дополнительного инференса. Центроиды обучаются
+    на собственной таблице messages: `python tools.py fit-intents`.
+    
+    Обращение к боту — правило, а не центроид (см. MessageAnalyzer.mentions_bot),
+    поэтому метка direct_mention не обучается. predict() отказывается отвечать,
+    если ближайший центроид дальше `min_score` или почти не отрывается от второго.
+    """
+    def __init__(self, labels: List[str], centroids: np.ndarray,
+                 min_score: float = 0.3, min_margin: float = 0.05):
+        self.labels = list(labels)
+        self.centroids = l2_normalize(np.asarray(centroids, dtype=np.float32))
+        self.min_score = min_score
+        self.min_margin = min_margin
+    
+    @classmethod
+    def fit(cls, embeddings: np.ndarray, labels: List[str]) -> "IntentRouter":
+        """Центроид каждой метки — нормированное среднее её эмбеддингов (кроме direct_mention)"""
+        embeddings = l2_normalize(np.asarray(embeddings, dtype=np.float32))
+        labels = np.asarray(labels)
+        present = [label for label in INTENT_LABELS
+                   if label != 'direct_mention' and (labels == label).any()]
+        centroids = np.stack([embeddings[labels == label].mean(axis=0) for label in present])
+        return cls(present, centroids)
+    
+    def classify(self, embedding: np.ndarray) -> Tuple[str, float, float]:
+        """(метка, косинусная близость к её центроиду, отрыв от второй по близости)"""
+        scores = self.centroids @ l2_normalize(embedding)
+        best = int(np.argmax(scores))
+        runner_up = np.max(np.delete(scores, best)) if len(scores) > 1 else -1.0
+        return self.labels[best], float(scores[best]), float(scores[best] - runner_up)
+    
+    def predict(self, embedding: np.ndarray) -> Optional[str]:
+        """Метка ближайшего центроида или None, если центроид не уверен"""
+        label, score, margin = self.classify(embedding)
+        # direct_mention мог остаться в центроидах, обученных старой версией
+        if label == 'direct_mention' or score < self.min_score or margin < self.min_margin:
+            return None
+        return label
+    
+    def save(self, path: str):
+        np.savez(path, labels=np.array(self.labels), centroids=self.centroids)
+    
+    @classmethod
+    def load(cls, path: str, min_score: float = 0.3, min_margin: float = 0.05) -> Optional["IntentRouter"]:
+        """Загрузить центроиды; None, если файла нет — тогда работают ключевые слова"""
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                router = cls(data['labels'].tolist(), data['centroids'], min_score, min_margin)
+            logger.info(f"🧭 Роутер намерений: {', '.join(router.labels)}")
+            return router
+        except Exception as e:
+            logger.error(f"❌ Не удалось загрузить центроиды намерений {path}: {e}")
+            return None
+
 # === АНАЛИЗАТОР СООБЩЕНИЙ ===
 class MessageAnalyzer:
-    def __init__(self):
-        self.bot_mentions = ['бот', 'bot', 'димон', '@']
+    def __init__(self, intent_router: Optional[IntentRouter] = None):
+        self.intent_router = intent_router
+        self.bot_mentions = ['бот', 'bot', 'димон']
         self.greeting_words = ['привет', 'здарова', 'салам', 'хай', 'hello', 'дарова']
-        self.question_indicators = ['?', 'как', 'что', 'где', 'когда', 'почему', 'зачем', 'можешь', 'помоги']
+        self.question_indicators = ['как', 'что', 'где', 'когда', 'почему', 'зачем', 'можешь', 'помоги']
         self.tech_words = ['код', 'программ', 'баг', 'сервер', 'база', 'api', 'фронт', 'бэк', 'js', 'python']
     
+    def mentions_bot(self, message: str) -> bool:
+        """Обращение к боту по имени или @username — детерминированное правило"""
+        message_lower = message.lower()
+        # @username бота в Telegram всегда оканчивается на bot
+        return bool(re.search(r'@\w*bot\b', message_lower)) or \
+            any(word.startswith(mention) for word in re.findall(r'\w+', message_lower)
+                for mention in self.bot_mentions)
+    
+    def keyword_intent(self, message: str) -> str:
+        """Намерение по ключевым словам: целые слова, а не подстроки
+        
+        Используется без обученных центроидов, когда центроид не уверен, и как
+        разметка для их обучения.
+        """
+        message_lower = message.lower()
+        words = re.findall(r'\w+', message_lower)
+        first_word = words[0] if words else ""
+        
+        if self.mentions_bot(message):
+            return 'direct_mention'
+        if any(word.startswith(tech) for word in words for tech in self.tech_words):
+            return 'tech_question'
+        if message_lower.rstrip().endswith('?') or first_word in self.question_indicators:
+            return 'question'
+        if any(first_word.startswith(greeting) for greeting in self.greeting_words):
+            return 'greeting'
+        return 'chatter'
+    
+    def detect_intent(self, message: str, embedding: Optional[np.ndarray] = None) -> str:
+        """Намерение сообщения
+        
+        Обращение к боту проверяется правилом первым — центроиды его не перекрывают.
+        Дальше — уверенный ближайший центроид, если есть эмбеддинг, иначе ключевые слова.
+        """
+        if self.mentions_bot(message):
+            return 'direct_mention'
+        if self.intent_router is not None and embedding is not None:
+            label = self.intent_router.predict(embedding)
+            if label is not None:
+                return label
+        return self.keyword_intent(message)
+    
     async def should_respond(self, message: str, context_manager: AdvancedContextManager, user: User, 
-                           is_private: bool = False, has_image: bool = False) -> Tuple[bool, str]:
+                           is_private: bool = False, has_image: bool = False,
+                           embedding: Optional[np.ndarray] = None) -> Tuple[bool, str]:
         """Анализ необходимости ответа"""
         if is_private:
             return True, "private_message"
-            
-        message_lower = message.lower()
         
-        profile = context_manager.user_profiles.get(user.id)
+        profile = await context_manager.user_profiles.fetch(user.id)
         relationship_bonus = 0
         if profile:
             if profile.relationship_level == "братан":
@@ -738,17 +3439,9 @@ class MessageAnalyzer:
             elif profile.relationship_level == "знакомый":
                 relationship_bonus = 0.1
         
-        if any(mention in message_lower for mention in self.bot_mentions):
-            return True, "direct_mention"
-        
-        if any(word in message_lower for word in self.tech_words):
-            return True, "tech_question"
-        
-        if any(indicator in message_lower for indicator in self.question_indicators):
-            return True, "question_to_chat"
-        
-        if any(greeting in message_lower for greeting in self.greeting_words):
-            return True, "greeting"
+        intent = self.detect_intent(message, embedding)
+        if intent in INTENT_REASONS:
+            return True, INTENT_REASONS[intent]
         
         if len(message) > 200:
             return True, "long_post"
@@ -901,10 +3594,15 @@ class PromptGenerator:
 
 # === ГЛАВНЫЙ КЛАСС БОТА (с добавлением планировщика) ===
 class SmartBot:
-    def __init__(self, config: BotConfig):
+    def __init__(self, config: BotConfig, encoder: Any = None):
         self.config = config
-        self.context_manager = AdvancedContextManager(config)
-        self.analyzer = MessageAnalyzer()
+        self.context_manager = AdvancedContextManager(config, encoder)
+        self.analyzer = MessageAnalyzer(IntentRouter.load(
+            config.intent_centroids_path, config.intent_min_score, config.intent_min_margin
+        ))
+        self.ingestion_filter = IngestionFilter(
+            config.ingest_duplicate_window, config.ingest_collapse_window, config.ingest_short_length
+        )
         self.prompt_generator = PromptGenerator()
         self.last_reaction: Dict[int, float] = defaultdict(float)
         self.semaphore = asyncio.Semaphore(config.max_parallel_requests)
@@ -985,10 +3683,10 @@ class SmartBot:
                 logger.error(f"Ошибка модели: {e}")
                 return "Что-то пошло не так, бля."
     
-    def check_cooldown(self, user_id: int) -> bool:
+    async def check_cooldown(self, user_id: int) -> bool:
         """Проверка кулдауна"""
         now = time.time()
-        profile = self.context_manager.user_profiles.get(user_id)
+        profile = await self.context_manager.user_profiles.fetch(user_id)
         
         cooldown = self.config.cooldown
         if profile:
@@ -1002,16 +3700,26 @@ class SmartBot:
         self.last_reaction[user_id] = now
         return True
     
-    def cleanup_old_data(self):
+    def _retention(self):
+        """Ретеншн БД и индексов: пачками, в пуле потоков"""
+        self.context_manager.db.cleanup_old_messages(
+            Constants.DEFAULT_CLEANUP_DAYS, self.config.retention_batch_size,
+            self.config.retention_pause_ms / 1000, self.config.retention_archive_dir
+        )
+        self.context_manager.prune_long_term_index()
+    
+    async def cleanup_old_data(self):
         """Очистка старых данных"""
         try:
-            self.context_manager.db.cleanup_old_messages(Constants.DEFAULT_CLEANUP_DAYS)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._retention)
             
             now = time.time()
             to_remove = [uid for uid, last_time in self.last_reaction.items() 
                         if now - last_time > self.config.cleanup_interval]
             for uid in to_remove:
                 del self.last_reaction[uid]
+            self.ingestion_filter.cleanup()
             
             logger.info(f"Очистка завершена. Удалено {len(to_remove)} записей кулдауна")
         except Exception as e:
@@ -1031,7 +3739,8 @@ async def create_message_object(user, message, chat_id: int) -> Message:
         chat_id=chat_id,
         message_id=message.message_id,
         is_reply=bool(message.reply_to_message),
-        reply_to_user=message.reply_to_message.from_user.full_name if message.reply_to_message else None
+        reply_to_user=message.reply_to_message.from_user.full_name if message.reply_to_message else None,
+        thread_id=getattr(message, 'message_thread_id', None)
     )
 
 
@@ -1046,34 +3755,57 @@ async def handle_flood_message(update: Update, context: ContextTypes.DEFAULT_TYP
     message = update.message
     
     # Проверки на валидность сообщения
-    if user.is_bot or not message.text or not smart_bot.check_cooldown(user.id):
+    if user.is_bot or not message.text:
+        return
+    # Дубли и флуд короткими сообщениями отсекаем до любой обработки; обращения к боту — нет
+    if not smart_bot.ingestion_filter.accept(update.effective_chat.id, user.id, message.text,
+                                             direct=smart_bot.analyzer.mentions_bot(message.text)):
+        return
+    if not await smart_bot.check_cooldown(user.id):
         return
     
     # Создаем объект сообщения
     msg = await create_message_object(user, message, update.effective_chat.id)
     
-    # Добавляем сообщение в контекст
-    smart_bot.context_manager.add_message(msg)
+    # Сообщение сразу видно в контексте; обогащение — после решения об ответе
+    smart_bot.context_manager.observe_message(msg)
     
-    # Проверяем нужно ли отвечать
+    # Роутеру намерений нужен эмбеддинг; без него (и при обращении к боту) решаем без модели.
+    # Решение нужно каждому сообщению, поэтому эмбеддинг — с фоновым приоритетом и под
+    # ограничением очереди: срочными становятся только сообщения, на которые бот отвечает
+    query_embedding = None
+    if smart_bot.analyzer.intent_router is not None and not smart_bot.analyzer.mentions_bot(msg.text):
+        query_embedding = await smart_bot.context_manager.embed_message(msg)
     should_respond, reason = await smart_bot.analyzer.should_respond(
-        msg.text, smart_bot.context_manager, user, is_private=False, has_image=False
+        msg.text, smart_bot.context_manager, user, is_private=False, has_image=False,
+        embedding=query_embedding
     )
     
     if not should_respond:
+        # Эмбеддинг и запись в БД — в фоне, пачками
+        await smart_bot.context_manager.defer_message(msg)
         return
     
+    # Ответу без воспоминаний эмбеддинг не нужен: обогащение уйдёт в фон после отправки
+    plan = RETRIEVAL_PLANS.get(reason, DEFAULT_RETRIEVAL_PLAN)
+    if plan.memories:
+        await smart_bot.context_manager.enrich_message(msg)
+    
     logger.info(f"💬 Отвечаю {user.full_name}: {reason}")
     
     try:
         # Генерируем ответ
-        smart_context = smart_bot.context_manager.get_smart_context(user.id, msg.text, limit=10)
-        user_profile = smart_bot.context_manager.user_profiles.get(user.id)
+        smart_context = await smart_bot.context_manager.get_smart_context(
+            user.id, msg.text, limit=10, query_embedding=query_embedding,
+            memory_filter=MemoryFilter(chat_id=msg.chat_id), reason=reason
+        )
+        user_profile = await smart_bot.context_manager.user_profiles.fetch(user.id)
         style_hint = smart_bot.analyzer.get_response_style(reason, msg.text, user_profile)
         
         prompt = smart_bot.prompt_generator.generate_prompt(
-            msg.text, smart_context, user_profile, reason, style_hint
+            msg.text, smart_context, user_profile if plan.profile else None, reason, style_hint
         )
+        smart_bot.context_manager.record_prompt(reason, prompt)
         
         # Показываем что печатаем и отправляем ответ
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
@@ -1087,6 +3819,9 @@ async def handle_flood_message(update: Update, context: ContextTypes.DEFAULT_TYP
         
     except Exception as e:
         logger.error(f"❌ Ошибка в handle_flood_message: {e}")
+    finally:
+        if not plan.memories:
+            await smart_bot.context_manager.defer_message(msg)
 
 async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка личных сообщений с изображениями"""
@@ -1095,7 +3830,12 @@ async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_T
     message = update.message
     
     # Проверки на валидность сообщения
-    if user.is_bot or not message.text or not smart_bot.check_cooldown(user.id):
+    if user.is_bot or not message.text:
+        return
+    # В личке всё адресовано боту: повтор и короткий ответ не отбрасываем
+    if not smart_bot.ingestion_filter.accept(update.effective_chat.id, user.id, message.text, direct=True):
+        return
+    if not await smart_bot.check_cooldown(user.id):
         return
     
     try:
@@ -1110,21 +3850,26 @@ async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_T
         )
         
         # Добавляем сообщение в контекст
-        smart_bot.context_manager.add_message(msg)
+        await smart_bot.context_manager.add_message(msg)
         
         # Показываем что печатаем
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
         
         # Генерируем ответ (в личке всегда отвечаем)
-        smart_context = smart_bot.context_manager.get_smart_context(user.id, msg.text, limit=5)
-        user_profile = smart_bot.context_manager.user_profiles.get(user.id)
-        
+        query_embedding = await smart_bot.context_manager.embed_message(msg, urgent=True)
         reason = "private_message"
+        smart_context = await smart_bot.context_manager.get_smart_context(
+            user.id, msg.text, limit=5, query_embedding=query_embedding,
+            memory_filter=MemoryFilter(chat_id=msg.chat_id), reason=reason
+        )
+        user_profile = await smart_bot.context_manager.user_profiles.fetch(user.id)
+        
         style = "Говори прямо, без сахара. Ты в личке."
         
         prompt = smart_bot.prompt_generator.generate_prompt(
             msg.text, smart_context, user_profile, reason, style
         )
+        smart_bot.context_manager.record_prompt(reason, prompt)
         
         reply = await smart_bot.ask_local_model(prompt)
         await message.reply_text(reply)
@@ -1184,18 +3929,17 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Расширенный статус с поддержкой изображений и планировщика"""
     try:
         recent_count = len(smart_bot.context_manager.recent_messages)
-        total_users = len(smart_bot.context_manager.user_profiles)
+        # Активные всегда в кэше; общие числа — по БД (без ещё не сброшенных изменений)
         active_users = len([p for p in smart_bot.context_manager.user_profiles.values() 
                            if time.time() - p.last_seen < Constants.ACTIVE_USER_THRESHOLD_SEC])
         
         images_count = sum(1 for msg in smart_bot.context_manager.recent_messages if msg.has_image)
         
-        relationships = defaultdict(int)
-        for profile in smart_bot.context_manager.user_profiles.values():
-            relationships[profile.relationship_level] += 1
+        relationships = smart_bot.context_manager.db.count_relationships()
+        total_users = sum(relationships.values())
         
         lm_status = "🟢 Фигачит" if await smart_bot.check_lm_studio_health() else "🔴 Сдох"
-        vision_status = "🟢 Включен" if smart_bot.config.enable_vision else "🔴 Отключен"
+        vision_status = "🟢 Включен" if getattr(smart_bot.config, 'enable_vision', False) else "🔴 Отключен"
         schedule_status = "🟢 Включен" if smart_bot.config.enable_schedule else "🔴 Отключен"
         
         # Московское время
@@ -1203,6 +3947,8 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if smart_bot.scheduler:
             moscow_time = smart_bot.scheduler.get_moscow_time().strftime('%H:%M')
         
+        embedder = smart_bot.context_manager.embedding_service
+        
         status_text = f"""📊 **Статус Димона**
         🧠 В памяти: {recent_count} сообщений
         📷 Картинок: {images_count}
@@ -1217,7 +3963,41 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         • Братанов: {relationships.get('братан', 0)}
         • Приятелей: {relationships.get('приятель', 0)}
         • Знакомых: {relationships.get('знакомый', 0)}
-        • Незнакомцев: {relationships.get('незнакомец', 0)}"""
+        • Незнакомцев: {relationships.get('незнакомец', 0)}
+
+        🧮 **Эмбеддинги ({smart_bot.config.embedding_backend}):**
+        • Размер батча (ср. {embedder.batch_sizes.mean:.1f}): {embedder.batch_sizes.render()}
+        • Ожидание, мс (ср. {embedder.wait_times_ms.mean:.1f}): {embedder.wait_times_ms.render()}
+        • Кэш: {embedder.hit_rate:.0%} попаданий ({embedder.cache_hits}/{embedder.cache_hits + embedder.cache_misses}), {len(embedder.cache)} записей
+        • Очередь: {embedder.queue.qsize() if embedder.queue else 0}/{embedder.max_pending}"""
+        if isinstance(embedder.encoder, ProcessEncoder):
+            status_text += f"\n        • Процесс-воркер: перезапусков {embedder.encoder.restarts}"
+        
+        ingestion = smart_bot.ingestion_filter
+        if ingestion.shed:
+            status_text += (f"\n        • Отсеяно на входе: {ingestion.shed} "
+                            f"(дубли {ingestion.counters['duplicate']}, повторы {ingestion.counters['user_repeat']}, "
+                            f"короткие {ingestion.counters['short_burst']}), принято {ingestion.counters['accepted']}")
+        
+        manager = smart_bot.context_manager
+        writes = manager.write_batch_sizes
+        status_text += (f"\n        \n        💾 **Запись в БД:** в очереди "
+                        f"{manager.write_queue.qsize() if manager.write_queue else 0}/{smart_bot.config.write_queue_size}")
+        if writes.total:
+            status_text += f", пачка ср. {writes.mean:.1f}: {writes.render()}"
+        profiles = manager.user_profiles
+        status_text += (f"\n        • Профили: в кэше {len(profiles)}/{profiles.capacity} "
+                        f"({profiles.hit_rate:.0%} попаданий), {len(profiles.dirty)} ждут записи, "
+                        f"записано {manager.profile_writes}")
+        
+        if manager.prompt_sizes:
+            status_text += "\n        \n        📏 **Контекст по причинам ответа:**"
+            for reason, sizes in sorted(manager.prompt_sizes.items(), key=lambda item: -item[1].total):
+                retrieval = manager.retrieval_times_ms.get(reason)
+                retrieval_ms = retrieval.mean if retrieval else 0.0
+                name = reason.replace('_', '\\_')  # Markdown: подчёркивание начинает курсив
+                status_text += (f"\n        • {name}: {sizes.total} шт., промпт ср. {sizes.mean:.0f} симв., "
+                                f"сбор контекста ср. {retrieval_ms:.1f} мс")
         
         if update.effective_chat.type == "private":
             await update.message.reply_text(status_text, parse_mode='Markdown')
@@ -1236,7 +4016,7 @@ async def memory(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать память о пользователе"""
     try:
         user_id = update.effective_user.id
-        profile = smart_bot.context_manager.user_profiles.get(user_id)
+        profile = await smart_bot.context_manager.user_profiles.fetch(user_id)
         
         if not profile:
             await update.message.reply_text("Тебя не помню, ты кто такой?")
@@ -1330,8 +4110,16 @@ async def main():
         logger.error("FLOOD_TOPIC_ID=your_topic_id (опционально)")
         return
     
+    encoder = None
+    if config.embedding_worker_process:
+        print("🧮 Запускаю процесс эмбеддингов...")
+        encoder = ProcessEncoder(functools.partial(
+            create_encoder, config.embedding_model, config.embedding_backend,
+            config.embedding_onnx_dir, config.embedding_max_seq_length
+        ))
+    
     print("🤖 Создаю экземпляр SmartBot...")
-    smart_bot = SmartBot(config)
+    smart_bot = SmartBot(config, encoder)
     print("✅ SmartBot создан успешно")
     
     logger.info(f"🔍 Проверяю LM Studio на {config.lm_studio_url}...")
@@ -1341,7 +4129,8 @@ async def main():
     else:
         logger.warning("⚠️ LM Studio недоступен!")
     
-    app = Application.builder().token(config.telegram_bot_token).build()
+    # Апдейты обрабатываются конкурентно: медленный ответ одному не тормозит остальные чаты
+    app = Application.builder().token(config.telegram_bot_token).concurrent_updates(True).build()
     
     # Фильтры
     class InFloodThreadFilter(filters.BaseFilter):
@@ -1369,11 +4158,24 @@ async def main():
     ))
     
     # Периодические задачи
-    def cleanup_job(context):
-        smart_bot.cleanup_old_data()
+    async def cleanup_job(context):
+        await smart_bot.cleanup_old_data()
     
     app.job_queue.run_repeating(cleanup_job, interval=config.cleanup_interval, first=config.cleanup_interval)
     
+    async def interest_clusters_job(context):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, smart_bot.context_manager.refresh_interest_clusters)
+    
+    app.job_queue.run_repeating(interest_clusters_job, interval=config.interest_refresh_interval,
+                                first=config.interest_refresh_interval)
+    
+    async def profile_flush_job(context):
+        await smart_bot.context_manager.flush_profiles()
+    
+    app.job_queue.run_repeating(profile_flush_job, interval=config.profile_flush_interval,
+                                first=config.profile_flush_interval)
+    
     # Планировщик сообщений
     if config.enable_schedule:
         app.job_queue.run_repeating(check_scheduled_messages, interval=Constants.SCHEDULER_CHECK_INTERVAL_SEC, first=10)
@@ -1397,6 +4199,13 @@ async def main():
         finally:
             await app.stop()
             await app.shutdown()
+            await smart_bot.context_manager.flush_enrichment()
+            await smart_bot.context_manager.flush_writes()
+            await smart_bot.context_manager.flush_profiles()
+            await smart_bot.context_manager.embedding_service.close()
+            smart_bot.context_manager.db.close()
+            if encoder is not None:
+                encoder.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -35,6 +35,9 @@ setup(
     ],
     python_requires=">=3.8",
     install_requires=requirements,
+    extras_require={
+        "onnx": ["onnxruntime>=1.16"],
+    },
     entry_points={
         "console_scripts": [
             "BydlanBot=bot:main",
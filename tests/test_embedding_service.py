@@ -0,0 +1,71 @@
+"""Тесты асинхронного сервиса эмбеддингов"""
+
+import asyncio
+import threading
+
+import numpy as np
+
+from bot import EmbeddingService
+
+
+class GatedEncoder:
+    """Энкодер, который ждёт разрешения перед каждым encode"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.texts = []
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        self.gate.wait(timeout=5)
+        self.texts.extend(texts)
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+
+def test_cancelled_put_does_not_orphan_pending_text():
+    """Отмена вызова, ждущего места в очереди, не вешает следующие вызовы с тем же текстом"""
+    async def scenario():
+        encoder = GatedEncoder()
+        service = EmbeddingService(encoder, max_wait_ms=0, max_batch=1, max_pending=1)
+        busy = asyncio.create_task(service.embed("первый"))  # занимает энкодер
+        await asyncio.sleep(0.05)
+        queued = asyncio.create_task(service.embed("второй"))  # занимает очередь
+        await asyncio.sleep(0.05)
+
+        blocked = asyncio.create_task(service.embed("третий"))
+        joined = asyncio.create_task(service.embed("третий"))
+        await asyncio.sleep(0.05)
+        blocked.cancel()
+        await asyncio.sleep(0)
+
+        encoder.gate.set()
+        again = await asyncio.wait_for(service.embed("третий"), timeout=5)
+        await asyncio.wait_for(asyncio.gather(busy, queued, joined), timeout=5)
+        await service.close()
+        return blocked, again, encoder.texts
+
+    blocked, again, texts = asyncio.run(scenario())
+    assert blocked.cancelled()
+    assert again.shape == (4,)
+    assert texts.count("третий") == 1
+
+
+def test_urgent_request_overtakes_background_queue():
+    """Запрос пути ответа не ждёт места и кодируется раньше накопленного фона"""
+    async def scenario():
+        encoder = GatedEncoder()
+        service = EmbeddingService(encoder, max_wait_ms=0, max_batch=1, max_pending=2)
+        busy = asyncio.create_task(service.embed("фон 0"))  # занимает энкодер
+        await asyncio.sleep(0.05)
+        background = [asyncio.create_task(service.embed(f"фон {n}")) for n in range(1, 4)]
+        await asyncio.sleep(0.05)  # очередь полна, "фон 3" ждёт места
+
+        urgent = asyncio.create_task(service.embed("ответ", urgent=True))
+        await asyncio.sleep(0.05)
+        encoder.gate.set()
+        await asyncio.wait_for(asyncio.gather(busy, urgent, *background), timeout=5)
+        await service.close()
+        return encoder.texts
+
+    texts = asyncio.run(scenario())
+    assert texts[:2] == ["фон 0", "ответ"]
+    assert sorted(texts[2:]) == ["фон 1", "фон 2", "фон 3"]
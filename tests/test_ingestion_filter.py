@@ -0,0 +1,23 @@
+"""Тесты фильтра дублей и коротких всплесков"""
+
+from bot import IngestionFilter
+
+
+def test_group_duplicates_and_short_bursts_are_dropped():
+    ingestion = IngestionFilter()
+    assert ingestion.accept(-100, 1, "деплой опять упал", now=0.0)
+    assert not ingestion.accept(-100, 2, "деплой опять упал", now=5.0)
+    assert ingestion.accept(-100, 1, "да", now=10.0)
+    assert not ingestion.accept(-100, 2, "нет", now=12.0)
+    assert ingestion.counters['duplicate'] == 1
+    assert ingestion.counters['short_burst'] == 1
+
+
+def test_messages_addressed_to_bot_are_never_dropped():
+    ingestion = IngestionFilter()
+    # Переспрос после «попробуй ещё раз» и короткие ответы подряд в личке
+    assert ingestion.accept(5, 5, "расскажи про сервер", now=0.0, direct=True)
+    assert ingestion.accept(5, 5, "расскажи про сервер", now=30.0, direct=True)
+    assert ingestion.accept(5, 5, "да", now=31.0, direct=True)
+    assert ingestion.accept(5, 5, "нет", now=32.0, direct=True)
+    assert ingestion.shed == 0
@@ -0,0 +1,33 @@
+"""Тесты определения намерения"""
+
+import numpy as np
+
+from bot import IntentRouter, MessageAnalyzer
+
+
+def make_router(**thresholds) -> IntentRouter:
+    centroids = np.eye(3, 4, dtype=np.float32)
+    return IntentRouter(["tech_question", "greeting", "chatter"], centroids, **thresholds)
+
+
+def test_mention_rule_wins_over_centroids():
+    analyzer = MessageAnalyzer(make_router())
+    greeting_like = np.array([0, 1, 0, 0], dtype=np.float32)
+    assert analyzer.detect_intent("Димон, здарова", greeting_like) == "direct_mention"
+    assert analyzer.detect_intent("глянь @my_helper_bot", greeting_like) == "direct_mention"
+    assert analyzer.detect_intent("здарова всем", greeting_like) == "greeting"
+
+
+def test_unsure_centroid_falls_back_to_keywords():
+    analyzer = MessageAnalyzer(make_router(min_score=0.5, min_margin=0.1))
+    between = np.array([1, 0.95, 0, 0], dtype=np.float32)  # tech_question и greeting почти поровну
+    far = np.array([0, 0, 0.2, 1], dtype=np.float32)  # далеко от всех центроидов
+    assert analyzer.detect_intent("сервер опять упал", between) == "tech_question"
+    assert analyzer.detect_intent("ну и погодка", between) == "chatter"
+    assert analyzer.detect_intent("как дела?", far) == "question"
+
+
+def test_fit_does_not_learn_direct_mention():
+    embeddings = np.eye(3, 4, dtype=np.float32)
+    router = IntentRouter.fit(embeddings, ["direct_mention", "greeting", "chatter"])
+    assert router.labels == ["greeting", "chatter"]
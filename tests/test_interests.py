@@ -0,0 +1,17 @@
+"""Тесты подписей кластеров интересов"""
+
+import pickle
+
+from bot import DatabaseManager, interest_keywords
+
+
+def test_keywords_skip_one_off_words_and_stopwords():
+    cluster = ["сервер опять упал, это жесть", "сервер перезапустил", "мой пароль hunter2, сервер"]
+    chat = cluster + ["рыбалка в субботу", "рыбалка отменяется"]
+    assert interest_keywords(cluster, chat) == "сервер"
+
+
+def test_legacy_shared_labels_are_dropped():
+    assert DatabaseManager._per_chat(pickle.dumps(["текст сообщения из лички"])) == {}
+    assert DatabaseManager._per_chat(pickle.dumps({-100: ["докер, сервер"]})) == {-100: ["докер, сервер"]}
+    assert DatabaseManager._per_chat(None) == {}
@@ -0,0 +1,40 @@
+"""Тесты IVF-индекса долговременной памяти"""
+
+import numpy as np
+
+from bot import IVFIndex
+
+DIM = 16
+
+
+def indexed_ids(index: IVFIndex) -> np.ndarray:
+    state = index.state
+    return np.sort(np.concatenate([ids[:size] for (_, ids, _), size in zip(state.lists, state.sizes)]))
+
+
+def random_vectors(count: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+
+
+def test_background_retrain_keeps_inserts_and_drops_made_meanwhile():
+    index = IVFIndex(DIM, nlist=16, train_threshold=2000)
+    index.add(np.arange(2000), random_vectors(2000, 0))  # запускает переобучение в фоне
+    for offset in range(2000, 5000, 500):
+        index.add(np.arange(offset, offset + 500), random_vectors(500, offset))
+    index.drop_ids_below(300)
+    index.wait_for_retrain(timeout=30)
+
+    assert index.state.centroids is not None
+    assert index.added_during_retrain is None
+    np.testing.assert_array_equal(indexed_ids(index), np.arange(300, 5000))
+
+
+def test_search_finds_vector_after_retrain():
+    vectors = random_vectors(3000, 1)
+    index = IVFIndex(DIM, nprobe=16, nlist=16, train_threshold=2000)
+    index.add(np.arange(3000), vectors)
+    index.wait_for_retrain(timeout=30)
+
+    ids, scores = index.search(vectors[1234], k=1)
+    assert ids.tolist() == [1234]
+    assert scores[0] > 0.99
@@ -0,0 +1,30 @@
+"""Тесты поиска по ключевым словам (FTS5)"""
+
+import pytest
+
+from bot import DatabaseManager, Message
+
+
+def test_fts_query_drops_stopwords_and_short_words():
+    assert DatabaseManager.fts_query("и не что это ну да") == ""
+    assert DatabaseManager.fts_query("что не так с сервером") == '"сервер"*'
+
+
+def test_fts_query_caps_terms_keeping_longest_words():
+    text = "кот пёс ёжик барсук носорог крокодил гиппопотам черепаха жираф лама"
+    terms = DatabaseManager.fts_query(text, max_terms=3).split(" OR ")
+    assert terms == ['"гиппопот"*', '"крокод"*', '"черепа"*']
+
+
+def test_search_ignores_stopword_matches(tmp_path):
+    db = DatabaseManager(str(tmp_path / "memory.db"))
+    try:
+        if not db.has_fts:
+            pytest.skip("SQLite собран без FTS5")
+        texts = ["что это было вообще", "что там с деплоем", "сервер опять упал"]
+        db.write_batch([db.message_row(Message(1, "user", text, 1000.0 + n, 1, n))
+                        for n, text in enumerate(texts)])
+        found = db.search_text("что с сервером")
+        assert [msg.text for msg in found] == ["сервер опять упал"]
+    finally:
+        db.close()
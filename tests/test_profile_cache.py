@@ -0,0 +1,70 @@
+"""Тесты LRU-кэша профилей"""
+
+import asyncio
+
+from bot import DatabaseManager, ProfileCache, UserProfile
+
+
+def make_profile(user_id: int, interaction_count: int = 0) -> UserProfile:
+    return UserProfile(user_id=user_id, username=f"user{user_id}", personality_traits={},
+                       interests=[], interaction_count=interaction_count, last_seen=1000.0,
+                       relationship_level="незнакомец")
+
+
+def counting_reads(monkeypatch, db: DatabaseManager) -> list:
+    reads = []
+    read = db.get_user_profile
+
+    def get_user_profile(user_id):
+        reads.append(user_id)
+        return read(user_id)
+
+    monkeypatch.setattr(db, "get_user_profile", get_user_profile)
+    return reads
+
+
+def test_evicted_profile_is_kept_until_flush_commits(tmp_path):
+    db = DatabaseManager(str(tmp_path / "memory.db"))
+    try:
+        old = make_profile(1, interaction_count=1)
+        db.write_batch([], [db.profile_row(old)])
+        cache = ProfileCache(db, capacity=1)
+
+        profile = cache.get(1)
+        profile.interaction_count = 5
+        cache.mark_dirty(profile)
+        cache[2] = make_profile(2)  # вытесняет грязный профиль 1
+
+        taken = cache.take_dirty()
+        cache[3] = make_profile(3)
+        # Запись ещё не закоммичена: в БД старая строка, а отдаётся объект из памяти
+        assert cache.get(1) is profile
+        cache[4] = make_profile(4)
+        assert cache.get(1).interaction_count == 5
+
+        db.write_batch([], [db.profile_row(p) for p in taken])
+        cache.commit_dirty(taken)
+        assert not cache.evicted
+        cache[5] = make_profile(5)
+        assert cache.get(1).interaction_count == 5
+    finally:
+        db.close()
+
+
+def test_missing_users_are_cached_and_fetched_off_loop(tmp_path, monkeypatch):
+    db = DatabaseManager(str(tmp_path / "memory.db"))
+    try:
+        cache = ProfileCache(db, capacity=4)
+        reads = counting_reads(monkeypatch, db)
+
+        async def scenario():
+            return [await cache.fetch(7) for _ in range(3)]
+
+        assert asyncio.run(scenario()) == [None, None, None]
+        assert cache.get(7) is None
+        assert reads == [7]
+
+        cache[7] = make_profile(7)
+        assert cache.get(7).user_id == 7
+    finally:
+        db.close()
@@ -0,0 +1,36 @@
+"""Планы запросов DatabaseManager: каждый запрос идёт по индексу, каждый индекс кем-то читается"""
+
+import re
+
+import pytest
+
+from bot import DatabaseManager
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DatabaseManager(str(tmp_path / "memory.db"))
+    yield db
+    db.close()
+
+
+def test_every_query_uses_an_index(db):
+    assert db.check_query_plans() == []
+
+
+def test_every_query_is_checked(db):
+    plans = db.query_plans()
+    expected = set(DatabaseManager.QUERIES)
+    if not db.has_fts:
+        expected.discard('keyword_search')
+    assert set(plans) == expected
+
+
+def test_every_index_is_used_by_some_query(db):
+    with db.reader() as conn:
+        indexes = {name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+        )}
+    used = {match for plan in db.query_plans().values() for detail in plan
+            for match in re.findall(r'INDEX (\w+)', detail)}
+    assert indexes - used == set()
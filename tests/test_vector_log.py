@@ -0,0 +1,77 @@
+"""Тесты журнала векторов на memmap-сегментах"""
+
+import numpy as np
+
+from bot import META_DTYPE, DatabaseManager, Message, VectorLog
+
+DIM = 8
+
+
+def make_batch(ids, timestamp: float = 1000.0):
+    ids = np.asarray(ids, dtype=np.int64)
+    vectors = np.zeros((len(ids), DIM), dtype=np.float32)
+    vectors[np.arange(len(ids)), ids % DIM] = 1.0
+    meta = np.zeros(len(ids), dtype=META_DTYPE)
+    meta['timestamp'] = timestamp
+    meta['thread_id'] = -1
+    return ids, vectors, meta
+
+
+def test_torn_append_is_truncated_on_open(tmp_path):
+    log = VectorLog(str(tmp_path), DIM)
+    log.append(*make_batch(range(10)))
+    segment = log.segments()[0]
+    # Падение посреди append: вектор и метаданные дописаны, ids — нет
+    with open(tmp_path / f"{segment}.vec", "ab") as f:
+        f.write(np.ones(DIM, dtype=np.float32).tobytes())
+    with open(tmp_path / f"{segment}.meta", "ab") as f:
+        f.write(np.zeros(1, dtype=META_DTYPE).tobytes())
+
+    log = VectorLog(str(tmp_path), DIM)
+    log.append(*make_batch(range(10, 15)))
+
+    ids, vectors, _ = next(log.iter_segments())
+    np.testing.assert_array_equal(ids, np.arange(15))
+    np.testing.assert_array_equal(np.argmax(vectors, axis=1), np.arange(15) % DIM)
+
+
+def test_ids_reports_holes_below_the_maximum(tmp_path):
+    log = VectorLog(str(tmp_path), DIM)
+    log.append(*make_batch([1, 2, 7, 8]))
+    np.testing.assert_array_equal(log.ids(), [1, 2, 7, 8])
+
+
+def test_embedded_ids_uses_partial_index(tmp_path):
+    db = DatabaseManager(str(tmp_path / "memory.db"))
+    try:
+        rows = []
+        for n in range(1, 6):
+            message = Message(1, "user", f"сообщение {n}", 1000.0 + n, 1, n)
+            embedding = np.ones(DIM, dtype=np.float32) if n % 2 else None
+            rows.append(db.message_row(message, embedding))
+        db.write_batch(rows, [])
+
+        np.testing.assert_array_equal(db.get_embedded_ids(max_id=5), [1, 3, 5])
+        batches = list(db.iter_embeddings_by_ids(np.array([3, 5])))
+        np.testing.assert_array_equal(np.concatenate([ids for ids, _, _ in batches]), [3, 5])
+        assert not [problem for problem in db.check_query_plans() if "embedded" in problem]
+    finally:
+        db.close()
+
+
+def test_torn_first_append_to_new_segment_is_truncated(tmp_path):
+    log = VectorLog(str(tmp_path), DIM)
+    # Падение на первой дозаписи в сегмент: векторы и метаданные есть, файла ids нет
+    segment = int(1000.0 // log.period)
+    _, vectors, meta = make_batch(range(3))
+    with open(tmp_path / f"{segment}.vec", "wb") as f:
+        f.write(np.zeros_like(vectors).tobytes())
+    with open(tmp_path / f"{segment}.meta", "wb") as f:
+        f.write(meta.tobytes())
+
+    log = VectorLog(str(tmp_path), DIM)
+    log.append(*make_batch([10, 11, 12]))
+
+    ids, vectors, _ = next(log.iter_segments())
+    np.testing.assert_array_equal(ids, [10, 11, 12])
+    np.testing.assert_array_equal(np.argmax(vectors, axis=1), [2, 3, 4])
@@ -0,0 +1,73 @@
+"""Тесты кольцевой векторной памяти"""
+
+import threading
+import time
+
+import numpy as np
+
+from bot import Message, VectorMemory
+
+DIM = 16
+
+
+class BasisEncoder:
+    """Энкодер без модели: текст "n" кодируется базисным вектором e[n % DIM]"""
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return DIM
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        vectors = np.zeros((len(texts), DIM), dtype=np.float32)
+        for row, text in enumerate(texts):
+            vectors[row, int(text) % DIM] = 1.0
+        return vectors
+
+
+def make_message(n: int) -> Message:
+    return Message(user_id=1, username="user", text=str(n), timestamp=time.time(),
+                   chat_id=1, message_id=n)
+
+
+def test_search_pairs_vectors_with_their_messages():
+    memory = VectorMemory("", capacity=8, encoder=BasisEncoder())
+    for n in range(20):
+        memory.add_message(make_message(n))
+
+    found = memory.search_similar("3", limit=5)
+    assert [msg.message_id % DIM for msg in found] == [3]
+    assert len(memory) == 8
+
+
+def test_search_while_overwriting_full_ring(monkeypatch):
+    """Поиск без блокировки не должен отдавать новый вектор со старым сообщением
+
+    Писатель останавливается между записью вектора и записью сообщения в слот,
+    и в этот момент в другом потоке идёт поиск.
+    """
+    memory = VectorMemory("", capacity=10, encoder=BasisEncoder())
+    for n in range(memory.capacity):
+        memory.add_message(make_message(n))
+
+    vector_written = threading.Event()
+    search_done = threading.Event()
+    write = memory.block.write
+
+    def paused_write(slot, vectors):
+        write(slot, vectors)
+        vector_written.set()
+        search_done.wait(timeout=5)
+
+    monkeypatch.setattr(memory.block, "write", paused_write)
+    # Сообщение 10 ложится в слот 0 поверх сообщения 0 с другим базисным вектором
+    writer = threading.Thread(target=memory.add_message, args=(make_message(10),))
+    writer.start()
+    try:
+        assert vector_written.wait(timeout=5)
+        query = np.eye(DIM, dtype=np.float32)[10]
+        found = [msg.message_id for _, msg in memory.search_scored(query, limit=5)]
+    finally:
+        search_done.set()
+        writer.join()
+
+    assert 0 not in found
+    assert [msg.message_id for msg in memory.search_similar("10")] == [10]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Maintenance tools for Smart Telegram Bot
+
+Запуск: python tools.py <команда> [параметры]
+Команды работают напрямую с базой бота (MEMORY_DB_PATH) и не требуют токена Telegram.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+from dotenv import load_dotenv
+
+from bot import INTENT_LABELS, DatabaseManager, IntentRouter, MessageAnalyzer
+
+load_dotenv()
+
+
+def fit_intents(args: argparse.Namespace):
+    """Обучить центроиды роутера намерений по сообщениям из таблицы messages
+
+    Разметка — правила MessageAnalyzer.keyword_intent; файл --labels (JSONL со
+    строками {"text": ..., "label": ...}) переопределяет метки для своих текстов.
+    Без ручной разметки центроиды лишь приближают те же правила. Обращения к боту
+    в обучение не идут: их всегда ловит правило MessageAnalyzer.mentions_bot.
+    """
+    overrides = {}
+    if args.labels:
+        with open(args.labels, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    if item["label"] not in INTENT_LABELS:
+                        sys.exit(f"❌ Неизвестная метка {item['label']!r}, допустимы: {INTENT_LABELS}")
+                    overrides[item["text"]] = item["label"]
+
+    analyzer = MessageAnalyzer()
+    texts, labels, embeddings = [], [], []
+    mentions = manual = 0
+    with sqlite3.connect(args.db) as conn:
+        rows = conn.execute(
+            "SELECT text, embedding, embedding_dim FROM messages WHERE embedding IS NOT NULL "
+            "ORDER BY id DESC LIMIT ?",
+            (args.limit,),
+        )
+        for text, blob, dim in rows:
+            label = overrides.get(text) or analyzer.keyword_intent(text or "")
+            if label == "direct_mention":
+                mentions += 1
+                continue
+            manual += text in overrides
+            texts.append(text)
+            labels.append(label)
+            embeddings.append(DatabaseManager.decode_embedding(blob, dim))
+
+    if not embeddings:
+        sys.exit("❌ В базе нет сообщений с эмбеддингами")
+
+    router = IntentRouter.fit(np.stack(embeddings), labels)
+    router.min_score = float(os.getenv("INTENT_MIN_SCORE", "0.3"))
+    router.min_margin = float(os.getenv("INTENT_MIN_MARGIN", "0.05"))
+    predicted = [router.classify(embedding)[0] for embedding in embeddings]
+    agreement = np.mean([p == l for p, l in zip(predicted, labels)])
+    confident = np.mean([router.predict(embedding) is not None for embedding in embeddings])
+
+    counts = Counter(labels)
+    print(f"🧭 Обучено на {len(labels)} сообщениях (обращений к боту пропущено: {mentions}):")
+    for label in router.labels:
+        print(f"{label:>16} {counts.get(label, 0):>7}")
+    print(f"Совпадение с разметкой: {agreement:.1%}")
+    print(f"Уверенных ответов центроидов: {confident:.1%}, остальное решают ключевые слова")
+    if not manual:
+        print("⚠️ Ручной разметки нет (--labels): центроиды только повторяют правила keyword_intent")
+    else:
+        print(f"Ручная разметка: {manual} из {len(labels)}")
+
+    router.save(args.output)
+    print(f"✅ Центроиды сохранены в {args.output}")
+
+
+def migrate_embeddings(args: argparse.Namespace):
+    """Переписать pickle-эмбеддинги в сырой формат пачками, не останавливая бота
+
+    Пачка читается, конвертируется и записывается короткой транзакцией, между
+    пачками — пауза, чтобы писатель бота не ждал замка базы. Прерванную
+    миграцию можно просто запустить снова: переписанные строки пропускаются.
+    """
+    storage = os.getenv("EMBEDDING_STORAGE", "float32").lower()
+    db = DatabaseManager(args.db, storage, embedding_model=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    last_id, total, started = 0, 0, time.time()
+    try:
+        while True:
+            next_id, converted = db.migrate_embeddings_batch(last_id, args.batch_size)
+            if next_id == last_id:
+                break
+            last_id = next_id
+            total += converted
+            print(f"🔁 Переписано {total} эмбеддингов (до id {last_id})")
+            time.sleep(args.pause_ms / 1000)
+    finally:
+        db.close()
+    print(f"✅ Миграция в {storage} завершена: {total} строк за {time.time() - started:.1f}с")
+
+
+def vacuum(args: argparse.Namespace):
+    """Один раз перевести базу в auto_vacuum=INCREMENTAL полным VACUUM
+
+    После этого ретеншн бота возвращает освободившиеся страницы порциями через
+    incremental_vacuum. VACUUM переписывает файл целиком и держит замок записи
+    всё это время, поэтому запускать лучше при остановленном боте.
+    """
+    db = DatabaseManager(args.db)
+    try:
+        with db.reader() as conn:
+            before = os.path.getsize(args.db)
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        db.close()
+    print(f"✅ VACUUM: {before / 2**20:.1f} → {os.path.getsize(args.db) / 2**20:.1f} МБ, "
+          f"auto_vacuum={'INCREMENTAL' if mode == 2 else mode}")
+
+
+def check_query_plans(args: argparse.Namespace):
+    """Проверить планы всех запросов DatabaseManager; код выхода 1 при полном скане или сортировке"""
+    db = DatabaseManager(args.db)
+    try:
+        problems = db.check_query_plans()
+    finally:
+        db.close()
+    if problems:
+        print("❌ Запросы без подходящего индекса:")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+    print(f"✅ Все {len(DatabaseManager.QUERIES)} запросов идут по индексам")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инструменты обслуживания бота")
+    parser.add_argument("--db", default=os.getenv("MEMORY_DB_PATH", "bot_memory.db"),
+                        help="путь к базе бота")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    intents = commands.add_parser("fit-intents", help="обучить центроиды роутера намерений")
+    intents.add_argument("--output", default=os.getenv("INTENT_CENTROIDS_PATH", "intent_centroids.npz"))
+    intents.add_argument("--limit", type=int, default=100_000, help="сколько последних сообщений брать")
+    intents.add_argument("--labels", help="JSONL с ручной разметкой {\"text\", \"label\"}")
+    intents.set_defaults(handler=fit_intents)
+
+    migrate = commands.add_parser("migrate-embeddings", help="переписать pickle-эмбеддинги в сырой формат")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--pause-ms", type=float, default=50, help="пауза между пачками")
+    migrate.set_defaults(handler=migrate_embeddings)
+
+    vacuum_parser = commands.add_parser("vacuum", help="включить инкрементальный vacuum (полный VACUUM, один раз)")
+    vacuum_parser.set_defaults(handler=vacuum)
+
+    plans = commands.add_parser("check-query-plans", help="проверить EXPLAIN QUERY PLAN запросов к базе")
+    plans.set_defaults(handler=check_query_plans)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()